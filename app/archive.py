@@ -0,0 +1,582 @@
+"""
+Telemetry archive: rows older than the hot window leave the database for
+compressed columnar files on local disk.
+
+    ARCHIVE_DIR/2026-10-17/shard-07/part-<first id>-<last id>.arc
+
+Files are partitioned by UTC day and by a hash of the node id. Inside a
+file rows are grouped per node and sorted by time; every column of every
+node is its own zlib block, so a history read memory-maps the file and
+decompresses only the blocks for one node and the columns it needs.
+
+File layout:
+
+    b"FLARC1\\0\\0"  magic
+    u32             header length
+    header          JSON: row count, day, byte order and, per node,
+                    row count, time range and {column: [offset, length, crc32]}
+    blocks          offsets are relative to the end of the header
+
+Numeric columns are float64 with NaN for NULL (ids, sessions and epoch
+microseconds all fit exactly); gateway columns are JSON string lists.
+
+The background job moves rows in chunks of ARCHIVE_CHUNK: write the part
+files, then delete exactly those ids, one short transaction per chunk. A
+crash in between leaves rows in both places; reads de-duplicate by id and
+`compact` removes the copies. Each run compacts the days it wrote to.
+
+    python -m app.archive run --days 30     # archive everything older
+    python -m app.archive compact [--day D] # merge part files per shard
+    python -m app.archive verify            # check every block and header
+    python -m app.archive reimport --from D [--to D] [--keep]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+
+from app import metrics
+from app.database import SessionLocal, async_engine
+from app.models import Telemetry, TelemetryCold
+
+logger = logging.getLogger(__name__)
+
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Rows older than this many days are archived; 0 turns the job off
+ARCHIVE_HOT_DAYS = float(os.getenv("ARCHIVE_HOT_DAYS", "0"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_CHUNK = int(os.getenv("ARCHIVE_CHUNK", "5000"))
+# Node hash partitions per day; changing it hides existing files
+ARCHIVE_SHARDS = int(os.getenv("ARCHIVE_SHARDS", "16"))
+
+MAGIC = b"FLARC1\0\0"
+_HEADER_LEN = struct.Struct("<I")
+
+NUMERIC_COLUMNS = (
+    "id", "session", "seq", "received_at", "temp", "hum",
+    "lat", "lon", "flame", "smoke", "rssi", "snr",
+)
+STRING_COLUMNS = ("gateway", "gateways")
+INT_COLUMNS = {"id", "session", "seq", "flame", "smoke", "rssi"}
+
+_EPOCH = datetime(1970, 1, 1)
+_NAN = float("nan")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _to_us(ts: datetime) -> float:
+    return (ts - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(us: float) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def shard_of(node: str, shards: int = ARCHIVE_SHARDS) -> int:
+    return zlib.crc32(node.encode()) % shards
+
+
+# -------------------------
+# Files
+# -------------------------
+def _column_values(rows: list[dict], column: str) -> list:
+    if column == "received_at":
+        return [_to_us(r["received_at"]) for r in rows]
+    return [_NAN if r[column] is None else r[column] for r in rows]
+
+
+def write_file(path: str, day: str, rows: list[dict]):
+    """Write rows (all of one day and shard) atomically to path."""
+    rows = sorted(rows, key=lambda r: (r["node"], r["received_at"], r["id"]))
+
+    by_node: dict[str, list[dict]] = {}
+    for row in rows:
+        by_node.setdefault(row["node"], []).append(row)
+
+    blocks = []
+    offset = 0
+    nodes = {}
+    for node, node_rows in by_node.items():
+        columns = {}
+        for column in NUMERIC_COLUMNS + STRING_COLUMNS:
+            if column in STRING_COLUMNS:
+                raw = json.dumps([r[column] for r in node_rows]).encode()
+            else:
+                raw = array("d", _column_values(node_rows, column)).tobytes()
+            block = zlib.compress(raw, 6)
+            columns[column] = [offset, len(block), zlib.crc32(block)]
+            blocks.append(block)
+            offset += len(block)
+
+        nodes[node] = {
+            "rows": len(node_rows),
+            "from": _to_us(node_rows[0]["received_at"]),
+            "to": _to_us(node_rows[-1]["received_at"]),
+            "columns": columns,
+        }
+
+    header = json.dumps({
+        "version": 1,
+        "day": day,
+        "rows": len(rows),
+        "byteorder": sys.byteorder,
+        "nodes": nodes,
+    }, separators=(",", ":")).encode()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LEN.pack(len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ArchiveFile:
+    """One .arc file, memory-mapped; blocks are decompressed on demand."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ArchiveError(f"{path}: not an archive file")
+        (length,) = _HEADER_LEN.unpack_from(self.mm, len(MAGIC))
+        start = len(MAGIC) + _HEADER_LEN.size
+        try:
+            self.header = json.loads(self.mm[start:start + length])
+        except ValueError:
+            self.close()
+            raise ArchiveError(f"{path}: corrupt header")
+        self.data_start = start + length
+        self.swap = self.header["byteorder"] != sys.byteorder
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def nodes(self) -> dict:
+        return self.header["nodes"]
+
+    def block(self, node: str, column: str, check: bool = False):
+        offset, length, crc = self.nodes[node]["columns"][column]
+        start = self.data_start + offset
+        raw = self.mm[start:start + length]
+        if check and zlib.crc32(raw) != crc:
+            raise ArchiveError(f"{self.path}: checksum mismatch in {node}/{column}")
+
+        data = zlib.decompress(raw)
+        if column in STRING_COLUMNS:
+            return json.loads(data)
+        values = array("d")
+        values.frombytes(data)
+        if self.swap:
+            values.byteswap()
+        return values
+
+    def read(self, node: str, start_us: float = -math.inf, end_us: float = math.inf,
+             columns=NUMERIC_COLUMNS + STRING_COLUMNS) -> list[dict]:
+        """Rows of one node with start_us <= received_at < end_us."""
+        meta = self.nodes.get(node)
+        if meta is None or meta["to"] < start_us or meta["from"] >= end_us:
+            return []
+
+        times = self.block(node, "received_at")
+        lo = bisect_left(times, start_us)
+        hi = bisect_left(times, end_us)
+        if lo >= hi:
+            return []
+
+        data = {"received_at": times}
+        for column in columns:
+            if column != "received_at":
+                data[column] = self.block(node, column)
+
+        rows = []
+        for i in range(lo, hi):
+            row = {"node": node}
+            for column in columns:
+                value = data[column][i]
+                if column == "received_at":
+                    value = _from_us(value)
+                elif column in STRING_COLUMNS:
+                    pass
+                elif math.isnan(value):
+                    value = None
+                elif column in INT_COLUMNS:
+                    value = int(value)
+                row[column] = value
+            rows.append(row)
+        return rows
+
+    def rows(self) -> list[dict]:
+        found = []
+        for node in self.nodes:
+            found.extend(self.read(node))
+        return found
+
+
+# -------------------------
+# Store
+# -------------------------
+class ArchiveStore:
+    def __init__(self, directory: str, shards: int):
+        self.directory = directory
+        self.shards = shards
+
+    def shard_dir(self, day: str, shard: int) -> str:
+        return os.path.join(self.directory, day, f"shard-{shard:02d}")
+
+    def days(self) -> list[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(d for d in os.listdir(self.directory) if len(d) == 10 and d[4] == "-")
+
+    def files(self, day: str, shard: int | None = None) -> list[str]:
+        shards = range(self.shards) if shard is None else (shard,)
+        found = []
+        for s in shards:
+            directory = self.shard_dir(day, s)
+            if os.path.isdir(directory):
+                found.extend(
+                    os.path.join(directory, name)
+                    for name in sorted(os.listdir(directory))
+                    if name.endswith(".arc")
+                )
+        return found
+
+    def write_rows(self, rows: list[dict]) -> set[str]:
+        """Partition rows by day and shard, one part file per partition; returns the days."""
+        parts: dict[tuple[str, int], list[dict]] = {}
+        for row in rows:
+            key = (row["received_at"].strftime("%Y-%m-%d"), shard_of(row["node"], self.shards))
+            parts.setdefault(key, []).append(row)
+
+        for (day, shard), part in parts.items():
+            ids = [r["id"] for r in part]
+            name = f"part-{min(ids)}-{max(ids)}.arc"
+            write_file(os.path.join(self.shard_dir(day, shard), name), day, part)
+        return {day for day, _ in parts}
+
+    def read(self, node: str, start: datetime, end: datetime) -> list[dict]:
+        """Archived rows of a node in [start, end), oldest first, de-duplicated by id."""
+        start_us, end_us = _to_us(start), _to_us(end)
+        shard = shard_of(node, self.shards)
+
+        seen = {}
+        day = datetime(start.year, start.month, start.day)
+        while day < end:
+            self._read_day(seen, day.strftime("%Y-%m-%d"), shard, node, start_us, end_us)
+            day += timedelta(days=1)
+
+        return sorted(seen.values(), key=lambda r: (r["received_at"], r["id"]))
+
+    def _read_day(self, seen: dict, day: str, shard: int, node: str,
+                  start_us: float, end_us: float, attempts: int = 3):
+        for attempt in range(attempts):
+            try:
+                for path in self.files(day, shard):
+                    with ArchiveFile(path) as f:
+                        for row in f.read(node, start_us, end_us):
+                            seen[row["id"]] = row
+                return
+            except FileNotFoundError:
+                # Compacted away after listing; the merged file holds
+                # the same rows, so list again
+                if attempt == attempts - 1:
+                    raise
+
+    def compact(self, day: str | None = None) -> dict:
+        """Merge the part files of each day/shard into one, dropping duplicate ids."""
+        report = {"merged": 0, "files_removed": 0, "duplicates_dropped": 0}
+        for d in ([day] if day else self.days()):
+            for shard in range(self.shards):
+                paths = self.files(d, shard)
+                if len(paths) < 2:
+                    continue
+
+                rows = {}
+                total = 0
+                for path in paths:
+                    with ArchiveFile(path) as f:
+                        for row in f.rows():
+                            rows[row["id"]] = row
+                            total += 1
+
+                ids = list(rows)
+                target = os.path.join(
+                    self.shard_dir(d, shard), f"part-{min(ids)}-{max(ids)}.arc"
+                )
+                write_file(target, d, list(rows.values()))
+                for path in paths:
+                    if path != target:
+                        os.unlink(path)
+                        report["files_removed"] += 1
+
+                report["merged"] += 1
+                report["duplicates_dropped"] += total - len(rows)
+        return report
+
+    def verify(self) -> list[str]:
+        """Every problem found, as readable strings; empty when all is well."""
+        problems = []
+        for day in self.days():
+            seen = set()
+            for path in self.files(day):
+                try:
+                    with ArchiveFile(path) as f:
+                        if f.header["day"] != day:
+                            problems.append(f"{path}: header day {f.header['day']}")
+                        counted = 0
+                        for node, meta in f.nodes.items():
+                            if shard_of(node, self.shards) != int(path.split("shard-")[1][:2]):
+                                problems.append(f"{path}: {node} is in the wrong shard")
+                            for column in NUMERIC_COLUMNS + STRING_COLUMNS:
+                                values = f.block(node, column, check=True)
+                                if len(values) != meta["rows"]:
+                                    problems.append(f"{path}: {node}/{column} has {len(values)} rows")
+                            times = f.block(node, "received_at")
+                            if list(times) != sorted(times):
+                                problems.append(f"{path}: {node} rows out of order")
+                            for value in f.block(node, "id"):
+                                if value in seen:
+                                    problems.append(f"{path}: duplicate id {int(value)}")
+                                seen.add(value)
+                            counted += meta["rows"]
+                        if counted != f.header["rows"]:
+                            problems.append(f"{path}: header says {f.header['rows']} rows, found {counted}")
+                except (ArchiveError, zlib.error, KeyError, ValueError) as exc:
+                    problems.append(f"{path}: {exc}")
+        return problems
+
+    def remove_day(self, day: str):
+        for path in self.files(day):
+            os.unlink(path)
+
+
+store = ArchiveStore(ARCHIVE_DIR, ARCHIVE_SHARDS)
+
+
+# -------------------------
+# Retention job
+# -------------------------
+class Archiver:
+    """
+    Moves telemetry (and telemetry_cold) rows older than the hot window
+    into the store, one bounded chunk per transaction. Only one process
+    runs it at a time: the others find the lock file taken and skip.
+    """
+
+    def __init__(self, store: ArchiveStore, hot_days: float, interval: float, chunk: int):
+        self.store = store
+        self.hot_days = hot_days
+        self.interval = interval
+        self.chunk = chunk
+        self._task: asyncio.Task | None = None
+
+        self.runs = 0
+        self.moved = 0
+        self.last_run_at: float | None = None
+        self.last_error: str | None = None
+
+    async def start(self):
+        if self.hot_days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive_before(datetime.utcnow() - timedelta(days=self.hot_days))
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.last_error = str(exc)
+                logger.exception("telemetry archive run failed")
+            await asyncio.sleep(self.interval)
+
+    def _lock(self):
+        os.makedirs(self.store.directory, exist_ok=True)
+        f = open(os.path.join(self.store.directory, ".lock"), "w")
+        # Imported here: fcntl is POSIX-only and this module is imported
+        # on every platform, through app.rollups
+        try:
+            if os.name == "nt":
+                import msvcrt
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Held by another worker
+            f.close()
+            return None
+        return f
+
+    async def archive_before(self, cutoff: datetime) -> int:
+        lock = self._lock()
+        if lock is None:
+            return 0
+
+        moved = 0
+        days = set()
+        try:
+            for table in (Telemetry.__table__, TelemetryCold.__table__):
+                while True:
+                    async with SessionLocal() as db:
+                        rows = (await db.execute(
+                            select(table)
+                            .where(table.c.received_at < cutoff)
+                            .order_by(table.c.received_at)
+                            .limit(self.chunk)
+                        )).mappings().all()
+                    if not rows:
+                        break
+
+                    rows = [dict(r) for r in rows]
+                    days |= await asyncio.to_thread(self.store.write_rows, rows)
+
+                    # Files are durable; now drop exactly these rows
+                    async with SessionLocal() as db:
+                        await db.execute(
+                            delete(table).where(table.c.id.in_([r["id"] for r in rows]))
+                        )
+                        await db.commit()
+
+                    moved += len(rows)
+                    self.moved += len(rows)
+                    metrics.archive_rows.inc(amount=len(rows))
+
+            # One file per day and shard again, so reads open few files
+            for day in sorted(days):
+                await asyncio.to_thread(self.store.compact, day)
+        finally:
+            lock.close()
+            self.runs += 1
+            self.last_run_at = time.time()
+
+        return moved
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.hot_days > 0,
+            "directory": self.store.directory,
+            "hot_days": self.hot_days,
+            "runs": self.runs,
+            "rows_archived": self.moved,
+            "last_run_at": self.last_run_at,
+            "last_error": self.last_error,
+            "days": len(self.store.days()),
+        }
+
+
+archiver = Archiver(store, ARCHIVE_HOT_DAYS, ARCHIVE_INTERVAL, ARCHIVE_CHUNK)
+
+
+async def reimport(first_day: str, last_day: str, keep: bool, chunk: int = ARCHIVE_CHUNK) -> int:
+    """Put archived rows back into the hot table; existing ids are skipped."""
+    insert_ignore = (
+        insert(Telemetry)
+        .prefix_with("IGNORE", dialect="mysql")
+        .prefix_with("OR IGNORE", dialect="sqlite")
+    )
+    restored = 0
+    for day in store.days():
+        if not first_day <= day <= last_day:
+            continue
+        for path in store.files(day):
+            with ArchiveFile(path) as f:
+                rows = f.rows()
+            for i in range(0, len(rows), chunk):
+                async with SessionLocal() as db:
+                    await db.execute(insert_ignore, rows[i:i + chunk])
+                    await db.commit()
+            restored += len(rows)
+        if not keep:
+            store.remove_day(day)
+    return restored
+
+
+# -------------------------
+# CLI
+# -------------------------
+def _run(coro):
+    async def run():
+        try:
+            return await coro
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run")
+    run.add_argument("--days", type=float, default=ARCHIVE_HOT_DAYS or None, required=not ARCHIVE_HOT_DAYS)
+    compact = sub.add_parser("compact")
+    compact.add_argument("--day")
+    sub.add_parser("verify")
+    restore = sub.add_parser("reimport")
+    restore.add_argument("--from", dest="first", required=True)
+    restore.add_argument("--to", dest="last")
+    restore.add_argument("--keep", action="store_true", help="leave the archive files in place")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        cutoff = datetime.utcnow() - timedelta(days=args.days)
+        print("archived", _run(archiver.archive_before(cutoff)), "rows")
+        return 0
+
+    if args.command == "compact":
+        print(store.compact(args.day))
+        return 0
+
+    if args.command == "verify":
+        problems = store.verify()
+        for problem in problems:
+            print(problem)
+        print(f"{len(store.days())} days checked, {len(problems)} problems")
+        return 1 if problems else 0
+
+    if args.command == "reimport":
+        restored = _run(reimport(args.first, args.last or args.first, args.keep))
+        print("reimported", restored, "rows")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
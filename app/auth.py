@@ -0,0 +1,203 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+
+# bcrypt runs in these processes, outside the GIL and the request threadpool
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Requests allowed to wait for a hashing slot before we answer 503
+AUTH_HASH_QUEUE = int(os.getenv("AUTH_HASH_QUEUE", "64"))
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", str(12 * 3600)))
+
+AUTH_SECRET = os.getenv("AUTH_SECRET", "").encode()
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+class Busy(Exception):
+    pass
+
+
+class InvalidToken(Exception):
+    pass
+
+
+# -------------------------
+# Worker process side
+# -------------------------
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, password_hash: str) -> bool:
+    return pwd_context.verify(password, password_hash)
+
+
+# -------------------------
+# Bounded hashing pool
+# -------------------------
+class HashPool:
+    """
+    Runs bcrypt in a small process pool. At most `workers` hashes run at
+    once; up to `queue` more may wait, anything beyond that is rejected
+    with Busy so a login storm can't pile up unbounded work.
+    """
+
+    def __init__(self, workers: int, queue: int):
+        self.workers = workers
+        self.queue = queue
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    def start(self):
+        # spawn, not fork: the parent is running an event loop and threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._slots = asyncio.Semaphore(self.workers)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        if self._executor is None:
+            self.start()
+
+        if self.waiting >= self.queue:
+            self.rejected += 1
+            raise Busy()
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        started = time.perf_counter()
+        wait = started - queued_at
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.run_total += time.perf_counter() - started
+            self._slots.release()
+
+    def stats(self) -> dict:
+        done = self.completed or 1
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_avg_s": round(self.wait_total / done, 4),
+            "queue_wait_max_s": round(self.wait_max, 4),
+            "hash_avg_s": round(self.run_total / done, 4),
+        }
+
+
+hash_pool = HashPool(workers=AUTH_HASH_WORKERS, queue=AUTH_HASH_QUEUE)
+
+
+async def hash_password(password: str) -> str:
+    return await hash_pool.run(_hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await hash_pool.run(_verify, password, password_hash)
+
+
+# -------------------------
+# Signed session tokens
+# -------------------------
+_secret: bytes | None = AUTH_SECRET or None
+
+
+def _secret_key() -> bytes:
+    global _secret
+    if _secret is None:
+        logger.warning(
+            "AUTH_SECRET is not set; using a random key, tokens will not "
+            "survive a restart or validate across workers"
+        )
+        _secret = secrets.token_bytes(32)
+    return _secret
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(body: str) -> str:
+    return _b64(hmac.new(_secret_key(), body.encode(), hashlib.sha256).digest())
+
+
+def issue_token(user) -> tuple[str, int]:
+    """HMAC-signed "<payload>.<signature>" token; returns (token, expires_at)."""
+    expires_at = int(time.time()) + AUTH_TOKEN_TTL
+    payload = {
+        "uid": user.id,
+        "sub": user.username,
+        "org": user.organization,
+        "exp": expires_at,
+    }
+    body = _b64(json.dumps(payload, separators=(",", ":")).encode())
+    return f"{body}.{_sign(body)}", expires_at
+
+
+def verify_token(token: str) -> dict:
+    """Cheap check, no bcrypt and no DB: signature then expiry."""
+    # Tokens are base64url; compare_digest refuses non-ASCII str
+    if not token.isascii():
+        raise InvalidToken("malformed token")
+    try:
+        body, signature = token.split(".")
+    except ValueError:
+        raise InvalidToken("malformed token")
+
+    if not hmac.compare_digest(signature, _sign(body)):
+        raise InvalidToken("bad signature")
+
+    try:
+        payload = json.loads(_unb64(body))
+    except ValueError:
+        raise InvalidToken("malformed token")
+
+    if payload.get("exp", 0) < time.time():
+        raise InvalidToken("token expired")
+
+    return payload
@@ -0,0 +1,274 @@
+"""
+Pub/sub backends that carry WebSocket events between uvicorn workers.
+
+Every backend delivers each published event to the local manager exactly
+once, including events published by this process. An event is encoded
+once by the publisher; the wire format is a small JSON routing header, a
+newline, then the client frame as published, before any worker stamps its
+own seq into it, so receiving workers never re-serialize it.
+
+    WS_BUS=local   in-process only (single worker, the default)
+    WS_BUS=unix    Unix datagram sockets in WS_BUS_DIR, no external service
+    WS_BUS=redis   Redis pub/sub on REDIS_URL (needs the redis package)
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Callable
+
+from app import encoding
+
+logger = logging.getLogger(__name__)
+
+
+WS_BUS = os.getenv("WS_BUS", "local")
+WS_BUS_DIR = os.getenv("WS_BUS_DIR", "/tmp/flames-bus")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL = os.getenv("REDIS_CHANNEL", "flames:events")
+
+
+class Event:
+    """
+    One broadcast. `frame` is the encoded client frame; `message` is the
+    decoded dict, parsed lazily on workers that received the frame. `seq`
+    is assigned by the receiving worker's manager, not carried on the wire.
+    """
+
+    __slots__ = ("kind", "node", "position", "ts", "frame", "_message", "origin", "seq")
+
+    def __init__(self, kind, node, position, ts, frame: str, message=None, origin=None):
+        self.kind = kind
+        self.node = node
+        self.position = position
+        self.ts = ts
+        self.frame = frame
+        self._message = message
+        self.origin = origin
+        self.seq = None
+
+    @property
+    def message(self) -> dict:
+        if self._message is None:
+            self._message = encoding.loads(self.frame)
+        return self._message
+
+    def to_wire(self) -> bytes:
+        header = encoding.dumps({
+            "k": self.kind,
+            "n": self.node,
+            "p": self.position,
+            "t": self.ts,
+            "o": self.origin,
+        })
+        return header + b"\n" + self.frame.encode()
+
+    @classmethod
+    def from_wire(cls, data: bytes) -> "Event":
+        header, frame = data.split(b"\n", 1)
+        h = encoding.loads(header)
+        position = tuple(h["p"]) if h["p"] is not None else None
+        return cls(h["k"], h["n"], position, h["t"], frame.decode(), origin=h["o"])
+
+
+class LocalBus:
+    """Single process: publishing is delivering."""
+
+    name = "local"
+
+    def __init__(self):
+        self.deliver: Callable[[Event], None] | None = None
+        self.origin: str | None = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self, deliver: Callable[[Event], None], origin: str):
+        self.deliver = deliver
+        self.origin = origin
+
+    async def stop(self):
+        pass
+
+    def publish(self, event: Event):
+        self.published += 1
+        if self.deliver is not None:
+            self.deliver(event)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+        }
+
+
+class UnixSocketBus(LocalBus):
+    """
+    One Unix datagram socket per worker in a shared directory. publish()
+    delivers locally, then sendto()s the same bytes to every peer socket.
+    Datagrams from one sender arrive in order, and sends never block: a
+    peer whose receive buffer is full loses the event and it is counted.
+    """
+
+    name = "unix"
+
+    def __init__(self, directory: str, rescan_interval: float = 1.0):
+        super().__init__()
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        self.path = os.path.join(directory, f"worker-{os.getpid()}.sock")
+        self.sock: socket.socket | None = None
+        self.peers: list[str] = []
+        self._scanned_at = 0.0
+
+    async def start(self, deliver, origin):
+        await super().start(deliver, origin)
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._on_readable)
+
+    async def stop(self):
+        if self.sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _scan(self):
+        now = time.monotonic()
+        if now - self._scanned_at < self.rescan_interval:
+            return
+        self._scanned_at = now
+        self.peers = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".sock") and os.path.join(self.directory, name) != self.path
+        ]
+
+    def publish(self, event: Event):
+        # Encode before the local delivery splices this worker's seq in
+        data = event.to_wire() if self.sock is not None else None
+        super().publish(event)
+        if data is None:
+            return
+
+        self._scan()
+        for peer in list(self.peers):
+            try:
+                self.sock.sendto(data, peer)
+            except BlockingIOError:
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Worker exited without cleaning up its socket
+                self.peers.remove(peer)
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+            except OSError:
+                logger.exception("bus send to %s failed", peer)
+                self.dropped += 1
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.received += 1
+            try:
+                self.deliver(Event.from_wire(data))
+            except Exception:
+                logger.exception("bad bus event")
+
+    def stats(self) -> dict:
+        return {**super().stats(), "peers": len(self.peers)}
+
+
+class RedisBus(LocalBus):
+    """
+    Redis pub/sub. Publishes go through one task so they leave in order;
+    our own events come back from Redis and are skipped by origin id.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, channel: str):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._outbox: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._redis = None
+
+    async def start(self, deliver, origin):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("WS_BUS=redis needs the 'redis' package installed")
+
+        await super().start(deliver, origin)
+        self._redis = redis.from_url(self.url)
+        self._outbox = asyncio.Queue()
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self.channel)
+        self._tasks = [
+            asyncio.create_task(self._send()),
+            asyncio.create_task(self._receive(pubsub)),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    def publish(self, event: Event):
+        # Encode before the local delivery splices this worker's seq in
+        data = event.to_wire() if self._outbox is not None else None
+        super().publish(event)
+        if data is not None:
+            self._outbox.put_nowait(data)
+
+    async def _send(self):
+        while True:
+            data = await self._outbox.get()
+            try:
+                await self._redis.publish(self.channel, data)
+            except Exception:
+                self.dropped += 1
+                logger.exception("bus publish failed")
+
+    async def _receive(self, pubsub):
+        async for item in pubsub.listen():
+            if item.get("type") != "message":
+                continue
+            event = Event.from_wire(item["data"])
+            if event.origin == self.origin:
+                continue
+            self.received += 1
+            self.deliver(event)
+
+
+def create_bus():
+    if WS_BUS == "local":
+        return LocalBus()
+    if WS_BUS == "unix":
+        return UnixSocketBus(WS_BUS_DIR)
+    if WS_BUS == "redis":
+        return RedisBus(REDIS_URL, REDIS_CHANNEL)
+    raise ValueError(f"unknown WS_BUS backend: {WS_BUS}")
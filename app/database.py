@@ -1,12 +1,17 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
 
+from app import metrics
 
 
-DATABASE_URL = (
+
+# DATABASE_URL overrides the DB_* settings, e.g. sqlite:///flames.db locally
+DATABASE_URL = os.getenv("DATABASE_URL") or (
     f"mysql+mysqlconnector://{os.getenv('DB_USER')}:"
     f"{os.getenv('DB_PASSWORD')}@"
     f"{os.getenv('DB_HOST')}:"
@@ -14,12 +19,110 @@ DATABASE_URL = (
     f"{os.getenv('DB_NAME')}"
 )
 
+# Connections kept open, extra ones allowed under load, and the age in
+# seconds after which a connection is replaced (below MySQL's wait_timeout)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Async driver used for the same database as DATABASE_URL
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url: str):
+    """DATABASE_URL with its driver swapped for the asyncio one."""
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"no async driver configured for {url.get_backend_name()}")
+    return url.set(drivername=driver)
+
+
+def _pool_options(url) -> dict:
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory SQLite lives in a single connection; no pool to size
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+
+
+# Blocking engine, only for migrations and the migrations CLI
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
+_async_url = async_url(DATABASE_URL)
+async_engine = create_async_engine(
+    _async_url, pool_pre_ping=True, **_pool_options(_async_url)
+)
+
+
+class TimedSession(Session):
+    def commit(self):
+        with metrics.db_commit.time():
+            super().commit()
+
+
+SessionLocal = async_sessionmaker(
+    async_engine,
+    sync_session_class=TimedSession,
+    # Rows stay readable after commit without another round trip
+    expire_on_commit=False,
+)
+
+
+async def get_db():
+    """The one way routes get a session; always closed, even on errors."""
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+# -------------------------
+# Pool instrumentation
+# -------------------------
+_engine = async_engine.sync_engine
+
+
+@event.listens_for(_engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    # QueuePool counts overflow from -pool_size, so > 0 means beyond the pool
+    overflow = getattr(_engine.pool, "overflow", lambda: 0)() > 0
+    metrics.db_pool_connects.inc("true" if overflow else "false")
+
+
+@event.listens_for(_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.db_pool_checkouts.inc()
+
+
+@event.listens_for(_engine, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    metrics.db_pool_invalidated.inc()
+
+
+def _pool_stat(name: str):
+    method = getattr(_engine.pool, name, None)
+    return method() if method is not None else 0
+
+
+metrics.registry.gauge(
+    "flames_db_pool_checked_out",
+    "Connections currently checked out of the pool.",
+    collect=lambda: _pool_stat("checkedout"),
+)
+metrics.registry.gauge(
+    "flames_db_pool_overflow",
+    "Connections open beyond pool_size (negative while below it).",
+    collect=lambda: _pool_stat("overflow"),
+)
+metrics.registry.gauge(
+    "flames_db_pool_size",
+    "Configured pool_size.",
+    collect=lambda: _pool_stat("size"),
+)
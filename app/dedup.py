@@ -0,0 +1,171 @@
+import os
+import time
+from collections import OrderedDict
+
+from app import metrics
+
+# How long a (node, session, seq) is remembered
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "60"))
+# How long after the first copy a better-signal copy may still replace it
+DEDUP_MERGE_WINDOW = float(os.getenv("DEDUP_MERGE_WINDOW", "1"))
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", "200000"))
+
+
+class GatewayStats:
+    __slots__ = ("packets", "duplicates", "best")
+
+    def __init__(self):
+        self.packets = 0
+        self.duplicates = 0
+        # times this gateway's copy replaced an earlier, weaker one
+        self.best = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "packets": self.packets,
+            "duplicates": self.duplicates,
+            "best_copy": self.best,
+            "duplicate_rate": round(self.duplicates / self.packets, 4) if self.packets else 0.0,
+        }
+
+
+def _signal(row: dict) -> tuple:
+    # Missing values rank below any real measurement
+    rssi = row.get("rssi")
+    snr = row.get("snr")
+    return (
+        rssi if rssi is not None else float("-inf"),
+        snr if snr is not None else float("-inf"),
+    )
+
+
+class Deduplicator:
+    """
+    Bounded, time-windowed index of recently seen (node, session, seq).
+
+    The first copy of a packet is kept and written; later copies are
+    dropped. Within the merge window a copy heard with a better RSSI/SNR
+    overwrites the signal fields of the kept row in place; the row is the
+    same dict that sits in the ingest queue and the latest-state store, so
+    the better copy is what gets written as long as it has not been flushed
+    yet. Every gateway that heard the packet is recorded in "gateways".
+    Readings without session/seq can't be told apart and always pass.
+
+    on_merge is called with the kept row whenever a copy changed it, so a
+    row that was already written can be updated (IngestPipeline.merge).
+    """
+
+    def __init__(self, window: float, merge_window: float, max_keys: int):
+        self.window = window
+        self.merge_window = merge_window
+        self.max_keys = max_keys
+        # key -> (first_seen, row); insertion order is arrival order
+        self.seen: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+        self.gateways: dict[str, GatewayStats] = {}
+        self.on_merge = None
+
+    def _expire(self, now: float):
+        seen = self.seen
+        while seen:
+            key, (first_seen, _) = next(iter(seen.items()))
+            if now - first_seen <= self.window and len(seen) <= self.max_keys:
+                break
+            seen.popitem(last=False)
+
+    def _gateway(self, name: str | None) -> GatewayStats:
+        name = name or "unknown"
+        stats = self.gateways.get(name)
+        if stats is None:
+            stats = self.gateways[name] = GatewayStats()
+        return stats
+
+    def filter(self, rows: list[dict]) -> list[dict]:
+        """Return the rows that are first copies, in order."""
+        now = time.monotonic()
+        self._expire(now)
+
+        fresh = []
+        for row in rows:
+            gateway = row.get("gateway")
+            stats = self._gateway(gateway)
+            stats.packets += 1
+            row["gateways"] = gateway
+
+            if row.get("session") is None or row.get("seq") is None:
+                fresh.append(row)
+                continue
+
+            key = (row["node"], row["session"], row["seq"])
+            entry = self.seen.get(key)
+
+            if entry is None:
+                self.seen[key] = (now, row)
+                fresh.append(row)
+                continue
+
+            stats.duplicates += 1
+            first_seen, kept = entry
+
+            changed = False
+            heard = kept["gateways"].split(",") if kept["gateways"] else []
+            if gateway and gateway not in heard:
+                heard.append(gateway)
+                kept["gateways"] = ",".join(heard)[:255]
+                changed = True
+
+            if now - first_seen <= self.merge_window and _signal(row) > _signal(kept):
+                kept["gateway"] = gateway
+                kept["rssi"] = row.get("rssi")
+                kept["snr"] = row.get("snr")
+                stats.best += 1
+                changed = True
+
+            if changed and self.on_merge is not None:
+                self.on_merge(kept)
+
+        return fresh
+
+    def forget(self, rows: list[dict]):
+        """Undo filter() for rows that could not be queued, so a retry is not a duplicate."""
+        for row in rows:
+            if row.get("session") is None or row.get("seq") is None:
+                continue
+            key = (row["node"], row["session"], row["seq"])
+            entry = self.seen.get(key)
+            if entry is not None and entry[1] is row:
+                del self.seen[key]
+
+    def stats(self) -> dict:
+        packets = sum(g.packets for g in self.gateways.values())
+        duplicates = sum(g.duplicates for g in self.gateways.values())
+        return {
+            "window_s": self.window,
+            "merge_window_s": self.merge_window,
+            "tracked": len(self.seen),
+            "packets": packets,
+            "duplicates": duplicates,
+            "duplicate_rate": round(duplicates / packets, 4) if packets else 0.0,
+            "gateways": {
+                name: g.as_dict() for name, g in sorted(self.gateways.items())
+            },
+        }
+
+
+dedup = Deduplicator(
+    window=DEDUP_WINDOW,
+    merge_window=DEDUP_MERGE_WINDOW,
+    max_keys=DEDUP_MAX_KEYS,
+)
+
+metrics.registry.counter(
+    "flames_gateway_packets_total",
+    "Packets received per gateway, duplicates included.",
+    labels=("gateway",),
+    collect=lambda: [((name,), g.packets) for name, g in list(dedup.gateways.items())],
+)
+metrics.registry.counter(
+    "flames_gateway_duplicates_total",
+    "Packets per gateway that were copies of one already received.",
+    labels=("gateway",),
+    collect=lambda: [((name,), g.duplicates) for name, g in list(dedup.gateways.items())],
+)
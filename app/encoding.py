@@ -0,0 +1,40 @@
+"""
+JSON encoding for API responses and WebSocket frames, backed by orjson.
+
+orjson serializes datetime natively (naive values come out exactly as
+isoformat() did), so payloads no longer need converting by hand first.
+"""
+from decimal import Decimal
+
+import orjson
+from fastapi.responses import Response
+
+
+def _default(value):
+    # MySQL aggregates can come back as Decimal
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def dumps_text(obj) -> str:
+    return dumps(obj).decode()
+
+
+loads = orjson.loads
+
+
+class JSONResponse(Response):
+    """
+    application/json rendered by orjson. Returning one directly from a
+    route also skips FastAPI's jsonable_encoder pass over the content.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
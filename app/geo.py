@@ -0,0 +1,162 @@
+import math
+import os
+from datetime import datetime
+
+# Grid cell edge in degrees; 0.01 is about 1.1 km north-south
+GEO_CELL_DEG = float(os.getenv("GEO_CELL_DEG", "0.01"))
+# Largest radius accepted by /nodes/near and /incidents/clusters, in meters
+GEO_MAX_RADIUS = float(os.getenv("GEO_MAX_RADIUS", "100000"))
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance in meters."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_box(lat: float, lon: float, radius_m: float) -> tuple[float, float, float, float]:
+    """Bounding box (min_lat, min_lon, max_lat, max_lon) around a circle."""
+    dlat = radius_m / METERS_PER_DEG_LAT
+    cos_lat = math.cos(math.radians(lat))
+    # Near the poles every longitude is within reach
+    dlon = 180.0 if cos_lat < 1e-6 else min(180.0, dlat / cos_lat)
+    return (
+        max(-90.0, lat - dlat), max(-180.0, lon - dlon),
+        min(90.0, lat + dlat), min(180.0, lon + dlon),
+    )
+
+
+class GridIndex:
+    """
+    Latest position per key, bucketed into a fixed lat/lon grid (the same
+    idea as a geohash prefix, without the string encoding). Updates move a
+    key between two cell sets; queries only visit the cells that overlap
+    the search box, or scan every point when the box covers more cells
+    than there are points.
+    """
+
+    def __init__(self, cell_deg: float = GEO_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells: dict[tuple[int, int], set] = {}
+        # key -> (lat, lon, cell)
+        self.points: dict = {}
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def clear(self):
+        self.cells.clear()
+        self.points.clear()
+
+    def update(self, key, lat: float, lon: float):
+        cell = self._cell(lat, lon)
+        current = self.points.get(key)
+        if current is not None and current[2] != cell:
+            self._discard(key, current[2])
+        if current is None or current[2] != cell:
+            self.cells.setdefault(cell, set()).add(key)
+        self.points[key] = (lat, lon, cell)
+
+    def remove(self, key):
+        current = self.points.pop(key, None)
+        if current is not None:
+            self._discard(key, current[2])
+
+    def _discard(self, key, cell):
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self.cells[cell]
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        lo_i, lo_j = self._cell(min_lat, min_lon)
+        hi_i, hi_j = self._cell(max_lat, max_lon)
+
+        if (hi_i - lo_i + 1) * (hi_j - lo_j + 1) > len(self.points):
+            yield from self.points
+            return
+
+        cells = self.cells
+        for i in range(lo_i, hi_i + 1):
+            for j in range(lo_j, hi_j + 1):
+                members = cells.get((i, j))
+                if members:
+                    yield from members
+
+    def within(self, min_lat, min_lon, max_lat, max_lon) -> list:
+        """Keys whose position lies inside the box, edges included."""
+        points = self.points
+        found = []
+        for key in self._candidates(min_lat, min_lon, max_lat, max_lon):
+            lat, lon, _ = points[key]
+            if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                found.append(key)
+        return found
+
+    def near(self, lat: float, lon: float, radius_m: float) -> list[tuple]:
+        """(key, distance_m) within radius_m of the point, nearest first."""
+        points = self.points
+        found = []
+        for key in self._candidates(*radius_box(lat, lon, radius_m)):
+            p_lat, p_lon, _ = points[key]
+            distance = haversine(lat, lon, p_lat, p_lon)
+            if distance <= radius_m:
+                found.append((key, distance))
+        found.sort(key=lambda item: item[1])
+        return found
+
+
+def _seconds_apart(a, b) -> float:
+    if isinstance(a, datetime) and isinstance(b, datetime):
+        try:
+            return abs((a - b).total_seconds())
+        except TypeError:
+            # naive vs aware; compare wall clocks
+            return abs((a.replace(tzinfo=None) - b.replace(tzinfo=None)).total_seconds())
+    return 0.0
+
+
+def cluster(items: list[dict], radius_m: float, window_s: float) -> list[list[dict]]:
+    """
+    Single-linkage clustering of dicts with "lat", "lon" and "updated_at":
+    two items belong to the same group when they are within radius_m of
+    each other and were updated within window_s of each other, directly or
+    through a chain of such neighbours. Items without a position are
+    returned as groups of one.
+    """
+    index = GridIndex(cell_deg=max(GEO_CELL_DEG, radius_m / METERS_PER_DEG_LAT))
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, item in enumerate(items):
+        if item.get("lat") is None or item.get("lon") is None:
+            continue
+        for j, _ in index.near(item["lat"], item["lon"], radius_m):
+            if _seconds_apart(item["updated_at"], items[j]["updated_at"]) <= window_s:
+                parent[find(i)] = find(j)
+        index.update(i, item["lat"], item["lon"])
+
+    groups: dict[int, list[dict]] = {}
+    for i, item in enumerate(items):
+        groups.setdefault(find(i), []).append(item)
+    return list(groups.values())
+
+
+# Latest position of every node, kept current by app/state.py
+node_index = GridIndex()
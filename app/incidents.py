@@ -0,0 +1,416 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+
+from sqlalchemy import select, update
+
+from app import geo
+from app.database import SessionLocal
+from app.models import Incident
+
+logger = logging.getLogger(__name__)
+
+
+SEVERITIES = ("LOW", "MEDIUM", "HIGH", "CRITICAL")
+
+# A rule becomes active when field >= on and stays active until field < off.
+DEFAULT_RULES = [
+    {"field": "flame", "on": 1, "off": 1, "severity": "HIGH"},
+    {"field": "temp", "on": 60, "off": 55, "severity": "HIGH"},
+    {"field": "temp", "on": 80, "off": 75, "severity": "CRITICAL"},
+    {"field": "smoke", "on": 300, "off": 250, "severity": "HIGH"},
+    {"field": "smoke", "on": 600, "off": 500, "severity": "CRITICAL"},
+]
+
+# Consecutive alarming readings needed to open an incident (debounce)
+INCIDENT_OPEN_AFTER = int(os.getenv("INCIDENT_OPEN_AFTER", "2"))
+# Consecutive clear readings needed to close it
+INCIDENT_CLOSE_AFTER = int(os.getenv("INCIDENT_CLOSE_AFTER", "3"))
+# Closed incidents kept in memory for /incidents
+INCIDENT_RECENT = int(os.getenv("INCIDENT_RECENT", "50"))
+
+
+class Rule:
+    def __init__(self, field: str, on: float, off: float, severity: str):
+        if severity not in SEVERITIES:
+            raise ValueError(f"unknown severity: {severity}")
+        if off > on:
+            raise ValueError(f"rule {field}: off threshold above on threshold")
+        self.field = field
+        self.on = on
+        self.off = off
+        self.severity = severity
+        self.level = SEVERITIES.index(severity)
+        self.name = f"{field}>={on}"
+
+
+def load_rules() -> list[Rule]:
+    raw = os.getenv("INCIDENT_RULES")
+    specs = json.loads(raw) if raw else DEFAULT_RULES
+    return [Rule(**spec) for spec in specs]
+
+
+class NodeState:
+    __slots__ = ("active", "alarm_streak", "clear_streak", "incident")
+
+    def __init__(self):
+        self.active: set[str] = set()
+        self.alarm_streak = 0
+        self.clear_streak = 0
+        self.incident: dict | None = None
+
+
+class IncidentEngine:
+    """
+    Evaluates every reading against the rules using per-node state and
+    turns the result into an incident lifecycle: opened -> escalated ->
+    closed. Open and recent incidents live in memory; every transition is
+    written to the incidents table by a single background writer, in order.
+
+    With several workers each one evaluates every reading, its own and
+    those relayed over the bus, so node state and /incidents agree across
+    workers. Only the worker that ingested a reading persists and
+    broadcasts the transitions it causes.
+    """
+
+    def __init__(self, rules: list[Rule], open_after: int, close_after: int,
+                 recent: int):
+        self.rules = rules
+        self.open_after = open_after
+        self.close_after = close_after
+        self.node_states: dict[str, NodeState] = {}
+        self.open: dict[str, dict] = {}
+        self.recent: deque[dict] = deque(maxlen=recent)
+        self._writes: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._lookups: set[asyncio.Task] = set()
+
+    # -------------------------
+    # Lifecycle
+    # -------------------------
+    async def load(self, db):
+        opened = (await db.execute(
+            select(Incident).where(Incident.status == "open")
+        )).scalars().all()
+
+        closed = (await db.execute(
+            select(Incident)
+            .where(Incident.status == "closed")
+            .order_by(Incident.closed_at.desc())
+            .limit(self.recent.maxlen)
+        )).scalars().all()
+
+        self.open.clear()
+        self.recent.clear()
+        self.node_states.clear()
+
+        for row in opened:
+            incident = _to_dict(row)
+            self.open[incident["node"]] = incident
+            self._state(incident["node"]).incident = incident
+
+        for row in reversed(closed):
+            self.recent.append(_to_dict(row))
+
+    async def start(self):
+        self._writes = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        for task in list(self._lookups):
+            task.cancel()
+        await self._writes.put(None)
+        await self._task
+        self._task = None
+
+    # -------------------------
+    # Evaluation
+    # -------------------------
+    def _state(self, node: str) -> NodeState:
+        st = self.node_states.get(node)
+        if st is None:
+            st = self.node_states[node] = NodeState()
+        return st
+
+    def evaluate(self, reading: dict, persist: bool = True) -> list[dict]:
+        """
+        Feed one reading; returns the transitions it caused, each a dict
+        with an "event" key (opened, escalated or closed). persist=False
+        for readings another worker ingested (and persists).
+        """
+        st = self._state(reading["node"])
+
+        for rule in self.rules:
+            value = reading.get(rule.field)
+            if value is None:
+                continue
+            if rule.name in st.active:
+                if value < rule.off:
+                    st.active.discard(rule.name)
+            elif value >= rule.on:
+                st.active.add(rule.name)
+
+        level = max(
+            (r.level for r in self.rules if r.name in st.active),
+            default=None
+        )
+
+        incident = st.incident
+
+        if incident is None:
+            if level is None:
+                st.alarm_streak = 0
+                return []
+            st.alarm_streak += 1
+            if st.alarm_streak < self.open_after:
+                return []
+            return [self._open(st, reading, level, persist)]
+
+        if level is None:
+            st.clear_streak += 1
+            if st.clear_streak >= self.close_after:
+                return [self._close(st, reading, persist)]
+            return []
+
+        st.clear_streak = 0
+        self._touch(incident, st, reading)
+
+        if level > SEVERITIES.index(incident["severity"]):
+            incident["severity"] = SEVERITIES[level]
+            if persist:
+                self._persist(incident)
+            return [self._event("escalated", incident)]
+
+        return []
+
+    def _open(self, st: NodeState, reading: dict, level: int, persist: bool) -> dict:
+        incident = {
+            "id": None,
+            "node": reading["node"],
+            "severity": SEVERITIES[level],
+            "status": "open",
+            "rules": "",
+            "lat": reading.get("lat"),
+            "lon": reading.get("lon"),
+            "peak_temp": None,
+            "peak_smoke": None,
+            "flame": 0,
+            "opened_at": reading["received_at"],
+            "updated_at": reading["received_at"],
+            "closed_at": None,
+        }
+        st.incident = incident
+        st.alarm_streak = 0
+        st.clear_streak = 0
+        self._touch(incident, st, reading)
+        self.open[incident["node"]] = incident
+        if persist:
+            self._persist(incident)
+        else:
+            self._follow(incident)
+        return self._event("opened", incident)
+
+    def _close(self, st: NodeState, reading: dict, persist: bool) -> dict:
+        incident = st.incident
+        incident["status"] = "closed"
+        incident["closed_at"] = reading["received_at"]
+        incident["updated_at"] = reading["received_at"]
+        st.incident = None
+        st.clear_streak = 0
+        self.open.pop(incident["node"], None)
+        self.recent.append(incident)
+        if persist:
+            self._persist(incident)
+        return self._event("closed", incident)
+
+    def _touch(self, incident: dict, st: NodeState, reading: dict):
+        incident["updated_at"] = reading["received_at"]
+        if reading.get("lat") is not None and reading.get("lon") is not None:
+            incident["lat"] = reading["lat"]
+            incident["lon"] = reading["lon"]
+
+        rules = set(filter(None, incident["rules"].split(","))) | st.active
+        incident["rules"] = ",".join(sorted(rules))
+
+        temp = reading.get("temp")
+        if temp is not None and (incident["peak_temp"] is None or temp > incident["peak_temp"]):
+            incident["peak_temp"] = temp
+        smoke = reading.get("smoke")
+        if smoke is not None and (incident["peak_smoke"] is None or smoke > incident["peak_smoke"]):
+            incident["peak_smoke"] = smoke
+        if reading.get("flame") == 1:
+            incident["flame"] = 1
+
+    def _event(self, event: str, incident: dict) -> dict:
+        return {"event": event, **public(incident)}
+
+    # -------------------------
+    # Queries
+    # -------------------------
+    def clusters(self, radius_m: float, window_s: float) -> list[dict]:
+        """
+        Open incidents grouped into fire fronts: incidents within radius_m
+        and window_s of each other (transitively) form one cluster.
+        Most severe, then largest, first.
+        """
+        groups = geo.cluster(list(self.open.values()), radius_m, window_s)
+        result = [_cluster(group) for group in groups]
+        result.sort(
+            key=lambda c: (SEVERITIES.index(c["severity"]), c["size"]),
+            reverse=True
+        )
+        return result
+
+    def list(self, status: str = "all", limit: int = 20) -> list[dict]:
+        items = []
+        if status in ("open", "all"):
+            items.extend(
+                sorted(self.open.values(), key=lambda i: i["opened_at"], reverse=True)
+            )
+        if status in ("closed", "all"):
+            items.extend(reversed(self.recent))
+        return [public(i) for i in items[:limit]]
+
+    # -------------------------
+    # Persistence
+    # -------------------------
+    def _persist(self, incident: dict):
+        if self._writes is not None:
+            # Snapshot now; the writer may run after further changes
+            self._writes.put_nowait((incident, dict(incident)))
+
+    async def _run(self):
+        while True:
+            item = await self._writes.get()
+            if item is None:
+                break
+            incident, snapshot = item
+            # The INSERT for this incident has completed by now
+            snapshot["id"] = incident["id"]
+            try:
+                incident_id = await self._write(snapshot)
+                incident["id"] = incident_id
+            except Exception:
+                logger.exception("failed to persist incident for node %s",
+                                 snapshot["node"])
+
+    def _follow(self, incident: dict):
+        # Opened from a reading another worker ingested; that worker
+        # inserts the row, so fetch its id once it is committed
+        if self._writes is not None:
+            task = asyncio.create_task(self._resolve_id(incident))
+            self._lookups.add(task)
+            task.add_done_callback(self._lookups.discard)
+
+    async def _resolve_id(self, incident: dict):
+        for delay in (0.1, 0.5, 1, 2, 5):
+            await asyncio.sleep(delay)
+            if incident["id"] is not None:
+                return
+            try:
+                async with SessionLocal() as db:
+                    incident["id"] = await _find_id(db, incident)
+            except Exception:
+                logger.exception("incident id lookup failed for node %s", incident["node"])
+            if incident["id"] is not None:
+                return
+        logger.warning("no incident row found for node %s opened at %s",
+                       incident["node"], incident["opened_at"])
+
+    async def _write(self, snapshot: dict) -> int:
+        values = {k: v for k, v in snapshot.items() if k != "id"}
+        async with SessionLocal() as db:
+            if snapshot["id"] is None:
+                # Opened from a reading another worker ingested: that
+                # worker inserted the row
+                snapshot["id"] = await _find_id(db, snapshot)
+            if snapshot["id"] is None:
+                row = Incident(**values)
+                db.add(row)
+                await db.commit()
+                return row.id
+            await db.execute(
+                update(Incident)
+                .where(Incident.id == snapshot["id"])
+                .values(**values)
+            )
+            await db.commit()
+            return snapshot["id"]
+
+
+async def _find_id(db, incident: dict) -> int | None:
+    return await db.scalar(
+        select(Incident.id).where(
+            Incident.node == incident["node"],
+            Incident.opened_at == incident["opened_at"]
+        )
+    )
+
+
+def _to_dict(row: Incident) -> dict:
+    return {
+        "id": row.id,
+        "node": row.node,
+        "severity": row.severity,
+        "status": row.status,
+        "rules": row.rules or "",
+        "lat": row.lat,
+        "lon": row.lon,
+        "peak_temp": row.peak_temp,
+        "peak_smoke": row.peak_smoke,
+        "flame": row.flame or 0,
+        "opened_at": row.opened_at,
+        "updated_at": row.updated_at,
+        "closed_at": row.closed_at,
+    }
+
+
+def _cluster(group: list[dict]) -> dict:
+    placed = [i for i in group if i["lat"] is not None and i["lon"] is not None]
+    lats = [i["lat"] for i in placed]
+    lons = [i["lon"] for i in placed]
+
+    return {
+        "size": len(group),
+        "severity": max((i["severity"] for i in group), key=SEVERITIES.index),
+        "nodes": sorted(i["node"] for i in group),
+        "incidents": [i["id"] for i in group],
+        "center": {
+            "lat": sum(lats) / len(lats),
+            "lon": sum(lons) / len(lons),
+        } if placed else None,
+        "bbox": [min(lats), min(lons), max(lats), max(lons)] if placed else None,
+        "flame": any(i["flame"] for i in group),
+        "opened_at": min(i["opened_at"] for i in group),
+        "updated_at": max(i["updated_at"] for i in group),
+    }
+
+
+def public(incident: dict) -> dict:
+    return {
+        "id": incident["id"],
+        "node": incident["node"],
+        "severity": incident["severity"],
+        "status": incident["status"],
+        "rules": incident["rules"].split(",") if incident["rules"] else [],
+        "lat": incident["lat"],
+        "lon": incident["lon"],
+        "peak_temp": incident["peak_temp"],
+        "peak_smoke": incident["peak_smoke"],
+        "flame": bool(incident["flame"]),
+        "timestamp": incident["opened_at"],
+        "updated_at": incident["updated_at"],
+        "closed_at": incident["closed_at"],
+    }
+
+
+incident_engine = IncidentEngine(
+    rules=load_rules(),
+    open_after=INCIDENT_OPEN_AFTER,
+    close_after=INCIDENT_CLOSE_AFTER,
+    recent=INCIDENT_RECENT,
+)
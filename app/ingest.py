@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import bindparam, insert, select, tuple_, union_all, update
+from sqlalchemy.exc import InterfaceError, OperationalError, StatementError
+
+from app import metrics, rollups, state
+from app.database import SessionLocal
+from app.models import Telemetry, TelemetryCold
+
+logger = logging.getLogger(__name__)
+
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+# Most readings one request may submit; submit() is all or nothing, so
+# never more than the queue holds
+INGEST_MAX_BATCH = min(int(os.getenv("INGEST_MAX_BATCH", "5000")), INGEST_QUEUE_SIZE)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.2"))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "5"))
+
+_STOP = object()
+# Wakes the idle writer to send pending merges
+_WAKE = object()
+
+# Copies of a packet already stored hit uq_telemetry_packet and are skipped
+insert_ignore = (
+    insert(Telemetry)
+    .prefix_with("IGNORE", dialect="mysql")
+    .prefix_with("OR IGNORE", dialect="sqlite")
+)
+
+
+# Gateway fields of a row rewritten after later copies of its packet;
+# matches nothing while the row is still queued, and the INSERT then
+# carries the merged values anyway
+_t = Telemetry.__table__
+merge_update = (
+    update(_t)
+    .where(
+        _t.c.node == bindparam("b_node"),
+        _t.c.session == bindparam("b_session"),
+        _t.c.seq == bindparam("b_seq"),
+    )
+    .values(
+        gateway=bindparam("b_gateway"),
+        rssi=bindparam("b_rssi"),
+        snr=bindparam("b_snr"),
+        gateways=bindparam("b_gateways"),
+    )
+)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _permanent(exc: Exception) -> bool:
+    # Bad data fails the same way on every attempt; connection trouble,
+    # deadlocks and lock timeouts may not
+    return (
+        isinstance(exc, StatementError)
+        and not isinstance(exc, (OperationalError, InterfaceError))
+    )
+
+
+class IngestPipeline:
+    """
+    Bounded in-process write stage for telemetry.
+
+    Handlers call submit() with plain row dicts and return immediately.
+    A single writer task pulls rows off the queue and flushes them with a
+    multi-row INSERT when either batch_size rows are waiting or
+    flush_interval seconds have passed since the first row of the batch.
+    Rows that dedup later merged gateway copies into are rewritten with
+    one UPDATE per packet after the next flush.
+    The write goes through the async engine, so the event loop keeps
+    serving requests and WebSocket sends while MySQL commits.
+    """
+
+    def __init__(self, maxsize: int, batch_size: int, flush_interval: float):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # (node, session, seq) -> row whose gateway fields changed
+        self.merged: dict[tuple, dict] = {}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Everything queued before the sentinel is flushed before exit
+        await self.queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def submit(self, rows: list[dict]):
+        """Queue rows for writing, all or nothing. Raises QueueFull."""
+        if self.queue is None:
+            raise RuntimeError("ingest pipeline not started")
+        if self.maxsize - self.queue.qsize() < len(rows):
+            raise QueueFull()
+        for row in rows:
+            self.queue.put_nowait(row)
+
+    def merge(self, row: dict):
+        """A later copy changed row's gateway fields (app/dedup.py)."""
+        if self.queue is None:
+            return
+        idle = not self.merged and self.queue.empty()
+        self.merged[(row["node"], row["session"], row["seq"])] = row
+        if idle:
+            self.queue.put_nowait(_WAKE)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self.queue.get()
+            if item is _STOP:
+                break
+
+            batch = [] if item is _WAKE else [item]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                if item is _STOP:
+                    stopping = True
+                    break
+                if item is not _WAKE:
+                    batch.append(item)
+
+            await self._flush(batch)
+
+        if self.merged:
+            await self._write_merged()
+
+    async def _flush(self, batch: list[dict]):
+        if batch:
+            with metrics.ingest_flush.time():
+                await self._flush_with_retries(batch)
+        if self.merged:
+            await self._write_merged()
+
+    async def _flush_with_retries(self, batch: list[dict]):
+        # Sub-batches not yet written; a retry resumes from here so parts
+        # that already committed are never written twice
+        parts = [batch]
+        delay = 0.5
+        for attempt in range(1, INGEST_MAX_RETRIES + 1):
+            try:
+                await self._write_parts(parts)
+                return
+            except Exception:
+                logger.exception(
+                    "telemetry flush failed (attempt %d/%d, %d rows)",
+                    attempt, INGEST_MAX_RETRIES, sum(map(len, parts))
+                )
+                if attempt < INGEST_MAX_RETRIES:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 10)
+
+        logger.error("dropping %d telemetry rows after %d attempts",
+                     sum(map(len, parts)), INGEST_MAX_RETRIES)
+
+    async def _write_parts(self, parts: list[list[dict]]):
+        """
+        Write and remove parts in order. A part whose data the database
+        rejects is bisected so only the offending rows are dropped; any
+        other error propagates with the unwritten parts left in `parts`.
+        """
+        while parts:
+            part = parts[0]
+            try:
+                await self._write(part)
+            except Exception as exc:
+                if not _permanent(exc):
+                    raise
+                parts.pop(0)
+                if len(part) == 1:
+                    logger.error("dropping telemetry row from node %r: %s",
+                                 part[0]["node"], exc)
+                    metrics.ingest_rejected.inc()
+                else:
+                    mid = len(part) // 2
+                    parts[0:0] = [part[:mid], part[mid:]]
+                continue
+
+            parts.pop(0)
+            metrics.ingest_rows.inc(amount=len(part))
+
+    async def _write_merged(self):
+        merged, self.merged = self.merged, {}
+        params = [
+            {
+                "b_node": row["node"], "b_session": row["session"], "b_seq": row["seq"],
+                "b_gateway": row["gateway"], "b_rssi": row["rssi"], "b_snr": row["snr"],
+                "b_gateways": row["gateways"],
+            }
+            for row in merged.values()
+        ]
+        try:
+            async with SessionLocal() as db:
+                conn = await db.connection()
+                await conn.execute(merge_update, params)
+                await db.commit()
+        except Exception:
+            logger.exception("gateway merge update failed (%d rows)", len(params))
+            # Tried again after the next flush unless superseded
+            for key, row in merged.items():
+                self.merged.setdefault(key, row)
+
+    async def _write(self, batch: list[dict]):
+        async with SessionLocal() as db:
+            fresh, rejected = await split_stored(db, batch)
+            if fresh:
+                await db.execute(insert_ignore, fresh)
+                # Rollups are folded in the same transaction as the raw
+                # rows, and only for rows that were actually added
+                await rollups.apply(db, fresh)
+            await db.commit()
+
+        for row, stored in rejected:
+            state.revert_node(row, stored)
+
+
+def _packet_key(row: dict):
+    # NULL session/seq never collide in uq_telemetry_packet
+    if row["session"] is None or row["seq"] is None:
+        return None
+    return (row["node"], row["session"], row["seq"])
+
+
+async def split_stored(db, batch: list[dict]) -> tuple[list[dict], list[tuple[dict, dict]]]:
+    """
+    Split a batch into rows insert_ignore will add and copies of packets
+    already stored (hot or cold table, or earlier in the batch), each
+    paired with the stored row. Copies get here once the dedup window has
+    passed.
+    """
+    keys = {key for key in map(_packet_key, batch) if key is not None}
+    stored = {}
+    if keys:
+        result = await db.execute(union_all(*(
+            select(*(t.c[f] for f in state.TELEMETRY_FIELDS))
+            .where(tuple_(t.c.node, t.c.session, t.c.seq).in_(keys))
+            for t in (Telemetry.__table__, TelemetryCold.__table__)
+        )))
+        for r in result.mappings():
+            stored[(r["node"], r["session"], r["seq"])] = dict(r)
+
+    fresh, rejected = [], []
+    for row in batch:
+        key = _packet_key(row)
+        if key is not None and key in stored:
+            rejected.append((row, stored[key]))
+            continue
+        if key is not None:
+            stored[key] = row
+        fresh.append(row)
+    return fresh, rejected
+
+
+pipeline = IngestPipeline(
+    maxsize=INGEST_QUEUE_SIZE,
+    batch_size=INGEST_BATCH_SIZE,
+    flush_interval=INGEST_FLUSH_INTERVAL,
+)
+
+metrics.registry.gauge(
+    "flames_ingest_queue_depth",
+    "Readings waiting for the telemetry writer.",
+    collect=lambda: pipeline.queue.qsize() if pipeline.queue is not None else 0,
+)
@@ -1,25 +1,87 @@
 import asyncio
+import math
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends
-from datetime import datetime
-from passlib.context import CryptContext
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Query, Header, Request
+from datetime import datetime, timedelta
 from app.models import User
 
-from sqlalchemy.orm import Session
-from sqlalchemy import text, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text, func, select
 
 from app.schemas import TelemetryIn, UserSignup, UserLogin
-from app.state import nodes, incidents
+from app import state
 from app.websocket import manager
 
-from app.database import SessionLocal, get_db
+from app.database import SessionLocal, async_engine, engine, get_db
+from app.dedup import dedup
+from app.ingest import INGEST_MAX_BATCH, pipeline, QueueFull
+from app.incidents import incident_engine
+from app import auth, geo, metrics, migrations, packed, rollups
+from app.archive import archiver
+from app.encoding import JSONResponse
 from app.models import Telemetry
 from app.schemas import TelemetryIn
 
 
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
-app = FastAPI(title="F.L.A.M.E.S Backend")
+async def load_state():
+    # DDL runs once at startup on the blocking engine
+    await asyncio.to_thread(migrations.upgrade, engine)
+
+    async with SessionLocal() as db:
+        await state.load_nodes(db)
+        await incident_engine.load(db)
+
+
+def apply_remote(event):
+    # Another worker ingested this reading; keep our /nodes store and
+    # incident state current (that worker persists and broadcasts)
+    if event.kind == "node_update":
+        row = dict(event.message["data"])
+        row["received_at"] = datetime.fromisoformat(row["received_at"])
+        state.update_node(row)
+        incident_engine.evaluate(row, persist=False)
+
+
+def dashboard_snapshot():
+    # What a dashboard would otherwise fetch from /nodes and /incidents
+    return {
+        "nodes": state.nodes_snapshot(),
+        "incidents": incident_engine.list(status="open", limit=len(incident_engine.open))
+    }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await load_state()
+    manager.remote_listeners.append(apply_remote)
+    manager.snapshot = dashboard_snapshot
+    dedup.on_merge = pipeline.merge
+    await manager.start()
+    await pipeline.start()
+    await incident_engine.start()
+    await archiver.start()
+    auth.hash_pool.start()
+    yield
+    auth.hash_pool.stop()
+    await archiver.stop()
+    # Flush whatever is still queued before the process exits
+    await pipeline.stop()
+    await incident_engine.stop()
+    await manager.stop()
+    await async_engine.dispose()
+
+
+app = FastAPI(
+    title="F.L.A.M.E.S Backend",
+    lifespan=lifespan,
+    default_response_class=JSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,8 +96,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    # Same body as FastAPI's handler, but rejected NaN/Infinity inputs
+    # echoed in the errors are written as null instead of failing with 500
+    return JSONResponse(
+        status_code=422,
+        content={"detail": jsonable_encoder(exc.errors())}
+    )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # -------------------------
 # Health Check
@@ -51,184 +123,287 @@ def root():
 import asyncio
 from fastapi import WebSocket, WebSocketDisconnect
 
+# ?stream=&since= resumes after the last seq the client saw (app/websocket.py)
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, since: int | None = None, stream: str | None = None):
+    await manager.connect(websocket, since=since, stream=stream)
     try:
-        # Keep connection open forever
-        await asyncio.Future()
+        # Reads subscribe/unsubscribe control messages until the client leaves
+        while True:
+            manager.handle_control(websocket, await websocket.receive_text())
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
 # -------------------------
 # Sensor Ingest
 # -------------------------
-@app.post("/ingest")
-async def ingest(data: TelemetryIn):
-    db = SessionLocal()
-
-    row = Telemetry(
-        node=data.node,
-        session=data.session,
-        seq=data.seq,
-        temp=data.temp,
-        hum=data.hum,
-        lat=data.lat,
-        lon=data.lon,
-        flame=data.flame,
-        smoke=data.smoke,
-        gateway=data.gateway,
-        rssi=data.rssi,
-        snr=data.snr,
-        received_at=data.received_at
-    )
+def enqueue(readings: list[dict]):
+    # Gateways may send "...Z"; everything past this point is naive UTC
+    for reading in readings:
+        reading["received_at"] = rollups.to_utc(reading["received_at"])
 
-    db.add(row)
-    db.commit()
-    db.close()
+    # Multi-gateway copies and retransmissions stop here
+    rows = dedup.filter(readings)
+    try:
+        pipeline.submit(rows)
+    except QueueFull:
+        dedup.forget(rows)
+        raise HTTPException(
+            status_code=429,
+            detail="Ingest queue full, retry later",
+            headers={"Retry-After": "1"}
+        )
 
-    # Fire detection
-    if data.flame == 1 or (data.temp and data.temp >= 60) or (data.smoke and data.smoke >= 300):
-        incident = {
-            "node": data.node,
-            "severity": "HIGH",
-            "timestamp": data.received_at.isoformat()
-        }
+    # Write-through so /nodes never has to go back to the table
+    for row in rows:
+        state.update_node(row)
+        metrics.readings_by_node.inc(row["node"])
 
-        await manager.broadcast({
+    return rows
+
+
+def publish(row: dict):
+    # Incidents are only broadcast when their state changes
+    for transition in incident_engine.evaluate(row):
+        manager.broadcast({
             "type": "incident",
-            "data": incident
+            "data": transition
         })
 
-    # ✅ JSON-SAFE NODE UPDATE
-    payload = data.model_dump()
-    payload["received_at"] = payload["received_at"].isoformat()
-
-    await manager.broadcast({
+    manager.broadcast({
         "type": "node_update",
-        "data": payload
+        "data": row
     })
-    
-    print("CLIENTS COUNT:", len(manager.clients))
 
 
+def store_one(reading: dict):
+    # "stored" means durably queued; the writer task commits it in a batch
+    rows = enqueue([reading])
+    if not rows:
+        return {"status": "duplicate"}
+
+    publish(rows[0])
+
     return {"status": "stored"}
 
 
+def store_many(readings: list[dict]):
+    if len(readings) > INGEST_MAX_BATCH:
+        # Would get 429 on every retry
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {INGEST_MAX_BATCH} readings per batch"
+        )
+
+    rows = enqueue(readings)
+
+    for row in rows:
+        publish(row)
+
+    return {
+        "status": "stored",
+        "count": len(rows),
+        "duplicates": len(readings) - len(rows)
+    }
+
+
+async def read_packed(request: Request, decode):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type != packed.CONTENT_TYPE:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Content-Type must be {packed.CONTENT_TYPE}"
+        )
+    try:
+        return decode(await request.body())
+    except packed.PackedError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+@app.post("/ingest")
+async def ingest(data: TelemetryIn):
+    return store_one(data.model_dump())
+
+
+@app.post("/ingest/batch")
+async def ingest_batch(readings: list[TelemetryIn]):
+    return store_many([r.model_dump() for r in readings])
+
+
+# Packed binary records (app/packed.py), no per-reading pydantic model
+@app.post("/ingest/packed")
+async def ingest_packed(request: Request):
+    return store_one(await read_packed(request, packed.decode_record))
+
+
+@app.post("/ingest/packed/batch")
+async def ingest_packed_batch(request: Request):
+    return store_many(await read_packed(request, packed.decode_batch))
+
+
 
 
 # -------------------------
 # Dashboard APIs
 # -------------------------
+# Served from the in-memory latest-state store (app/state.py). These stay
+# on the event loop: the store is mutated there and is never locked.
+# Returning JSONResponse directly skips FastAPI's jsonable_encoder pass.
 @app.get("/nodes")
-def get_nodes():
-    db = SessionLocal()
+async def get_nodes(bbox: str | None = None):
+    if bbox is None:
+        return JSONResponse(state.nodes_snapshot())
 
-    rows = (
-        db.query(Telemetry)
-        .order_by(Telemetry.received_at.desc())
-        .all()
-    )
+    try:
+        min_lat, min_lon, max_lat, max_lon = (float(v) for v in bbox.split(","))
+        if not all(map(math.isfinite, (min_lat, min_lon, max_lat, max_lon))):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="bbox must be min_lat,min_lon,max_lat,max_lon"
+        )
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=400, detail="bbox minimum is greater than maximum")
 
-    db.close()
+    return JSONResponse(state.nodes_snapshot(
+        geo.node_index.within(min_lat, min_lon, max_lat, max_lon)
+    ))
 
-    latest = {}
-    for r in rows:
-        if r.node not in latest:
-            latest[r.node] = {
-                "node": r.node,
-                "lat": r.lat,
-                "lon": r.lon,
-                "temp": r.temp,
-                "hum": r.hum,
-                "smoke": r.smoke,
-                "flame": bool(r.flame),
-                "received_at": r.received_at
-            }
 
-    return latest
+# nodes within radius meters of a point, nearest first
+@app.get("/nodes/near")
+async def get_nodes_near(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius: float = Query(1000, gt=0, le=geo.GEO_MAX_RADIUS),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    found = geo.node_index.near(lat, lon, radius)[:limit]
+    snapshot = state.nodes_snapshot(node for node, _ in found)
 
+    return JSONResponse([
+        {**snapshot[node], "distance_m": round(distance, 1)}
+        for node, distance in found
+        if node in snapshot
+    ])
 
-@app.get("/nodes/{node_id}")
-def get_node(node_id: str):
-    db = SessionLocal()
-
-    row = (
-        db.query(Telemetry)
-        .filter(Telemetry.node == node_id)
-        .order_by(Telemetry.received_at.desc())
-        .first()
-    )
 
-    db.close()
+# latest update
+@app.get("/nodes/latest")
+async def get_latest_nodes():
+    return JSONResponse(state.latest_rows())
+
+
+@app.get("/nodes/{node_id}")
+async def get_node(node_id: str):
+    node = state.node_snapshot(node_id)
 
-    if not row:
+    if not node:
         return []
 
-    return {
-        "node": row.node,
-        "lat": row.lat,
-        "lon": row.lon,
-        "temp": row.temp,
-        "hum": row.hum,
-        "smoke": row.smoke,
-        "flame": bool(row.flame),
-        "received_at": row.received_at
-    }
+    return JSONResponse(node)
 
 
 
-@app.get("/incidents")
-def get_incidents():
-    db = SessionLocal()
-
-    rows = (
-        db.query(Telemetry)
-        .filter(
-            (Telemetry.flame == 1) |
-            (Telemetry.temp >= 60) |
-            (Telemetry.smoke >= 300)
+@app.get("/nodes/{node_id}/history")
+async def get_node_history(
+    node_id: str,
+    start: datetime | None = Query(None, alias="from"),
+    end: datetime | None = Query(None, alias="to"),
+    resolution: str = "auto",
+    points: int = Query(200, ge=1, le=rollups.HISTORY_MAX_POINTS),
+    db: AsyncSession = Depends(get_db),
+):
+    end = rollups.to_utc(end) if end else datetime.utcnow()
+    start = rollups.to_utc(start) if start else end - timedelta(hours=24)
+
+    if start >= end:
+        raise HTTPException(status_code=400, detail="from must be before to")
+
+    if resolution == "auto":
+        resolution = rollups.pick_resolution(start, end, points)
+    elif resolution != "raw" and resolution not in rollups.RESOLUTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail="resolution must be auto, raw, minute, hour or day"
         )
-        .order_by(Telemetry.received_at.desc())
-        .limit(20)
-        .all()
-    )
 
-    db.close()
+    data, truncated = await rollups.history(db, node_id, start, end, resolution)
 
-    incidents = []
-    seen_nodes = set()
+    return JSONResponse({
+        "node": node_id,
+        "from": start,
+        "to": end,
+        "resolution": resolution,
+        # Only HISTORY_MAX_POINTS points, oldest first; narrow the range
+        "truncated": truncated,
+        "points": data
+    })
+
+
+
+@app.get("/incidents")
+async def get_incidents(status: str = "all", limit: int = Query(20, ge=1, le=1000)):
+    if status not in ("open", "closed", "all"):
+        raise HTTPException(status_code=400, detail="status must be open, closed or all")
+
+    return JSONResponse(incident_engine.list(status=status, limit=limit))
 
-    for r in rows:
-        if r.node not in seen_nodes:
-            incidents.append({
-                "node": r.node,
-                "severity": "HIGH",
-                "lat": r.lat,
-                "lon": r.lon,
-                "timestamp": r.received_at
-            })
-            seen_nodes.add(r.node)
 
-    return incidents
+# open incidents grouped into fire fronts by distance and time
+@app.get("/incidents/clusters")
+async def get_incident_clusters(
+    radius: float = Query(2000, gt=0, le=geo.GEO_MAX_RADIUS),
+    window: float = Query(600, ge=0),
+):
+    return JSONResponse(incident_engine.clusters(radius_m=radius, window_s=window))
 
 
 
 # -------------------------
 # Authentication APIs
 # -------------------------
-@app.post("/auth/signup")
-def signup(user: UserSignup):
-    db = SessionLocal()
+async def find_user(db: AsyncSession, username: str):
+    result = await db.execute(select(User).where(User.username == username))
+    found = result.scalars().first()
+    # End the read so the connection goes back to the pool while the
+    # caller waits on bcrypt; expire_on_commit=False keeps `found` loaded
+    await db.commit()
+    return found
+
+
+async def hash_or_busy(fn, *args):
+    try:
+        return await fn(*args)
+    except auth.Busy:
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication is busy, retry shortly",
+            headers={"Retry-After": "1"}
+        )
+
 
+def current_user(authorization: str | None = Header(None)) -> dict:
+    if not authorization or not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    try:
+        return auth.verify_token(authorization[7:].strip())
+    except auth.InvalidToken as exc:
+        raise HTTPException(status_code=401, detail=str(exc))
+
+
+@app.post("/auth/signup")
+async def signup(user: UserSignup, db: AsyncSession = Depends(get_db)):
     # check duplicate username
-    if db.query(User).filter(User.username == user.username).first():
-        db.close()
+    if await find_user(db, user.username):
         raise HTTPException(status_code=400, detail="Username already exists")
 
     password = user.password.encode("utf-8")[:72].decode("utf-8")
-    hashed = pwd_context.hash(password)
+    hashed = await hash_or_busy(auth.hash_password, password)
 
 
     new_user = User(
@@ -238,31 +413,30 @@ def signup(user: UserSignup):
     )
 
     db.add(new_user)
-    db.commit()
-    db.close()
+    await db.commit()
 
     return {"message": "User registered successfully"}
 
 
 @app.post("/auth/login")
-def login(user: UserLogin):
-    db = SessionLocal()
-
-    db_user = db.query(User).filter(User.username == user.username).first()
+async def login(user: UserLogin, db: AsyncSession = Depends(get_db)):
+    db_user = await find_user(db, user.username)
     if not db_user:
-        db.close()
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
     password = user.password.encode("utf-8")[:72].decode("utf-8")
 
-    if not pwd_context.verify(password, db_user.password_hash):
-        db.close()
+    if not await hash_or_busy(auth.verify_password, password, db_user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
-    db.close()
+    # Clients send this token from now on instead of the password
+    token, expires_at = auth.issue_token(db_user)
 
     return {
         "message": "Login successful",
+        "token": token,
+        "token_type": "bearer",
+        "expires_at": expires_at,
         "user": {
             "id": db_user.id,
             "username": db_user.username,
@@ -271,33 +445,50 @@ def login(user: UserLogin):
     }
 
 
-# latest update
-@app.get("/nodes/latest")
-def get_latest_nodes(db: Session = Depends(get_db)):
-    subquery = (
-        db.query(
-            Telemetry.node,
-            func.max(Telemetry.received_at).label("max_time")
-        )
-        .group_by(Telemetry.node)
-        .subquery()
-    )
+@app.get("/auth/me")
+async def me(session: dict = Depends(current_user)):
+    return {
+        "id": session["uid"],
+        "username": session["sub"],
+        "organization": session["org"],
+        "expires_at": session["exp"]
+    }
 
-    rows = (
-        db.query(Telemetry)
-        .join(
-            subquery,
-            (Telemetry.node == subquery.c.node)
-            & (Telemetry.received_at == subquery.c.max_time)
-        )
-        .all()
+
+# -------------------------
+# Monitoring
+# -------------------------
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
     )
 
-    return rows
+
+@app.get("/debug/auth")
+async def debug_auth():
+    return auth.hash_pool.stats()
+
+
+@app.get("/debug/archive")
+async def debug_archive():
+    return archiver.stats()
+
+
+@app.get("/debug/dedup")
+async def debug_dedup():
+    return dedup.stats()
+
+@app.get("/debug/ws")
+async def debug_ws():
+    return {
+        "policy": manager.policy,
+        "bus": manager.bus_stats(),
+        "clients": manager.stats()
+    }
 
 @app.get("/debug/db")
-def debug_db():
-    db = SessionLocal()
-    count = db.query(Telemetry).count()
-    db.close()
+async def debug_db(db: AsyncSession = Depends(get_db)):
+    count = await db.scalar(select(func.count()).select_from(Telemetry))
     return {"telemetry_rows": count}
\ No newline at end of file
@@ -0,0 +1,285 @@
+"""
+Prometheus metrics, rendered in the text exposition format on /metrics.
+
+Hand-rolled rather than prometheus_client so the hot path stays a dict
+lookup and an integer add: every labelled child and its bucket array is
+allocated once, on first use, and nothing takes a lock. Every update
+happens on the event loop thread (the database runs on the asyncio
+engine, including its pool events), so increments never race.
+
+Gauges that describe current state (connected clients, node ages, pool
+usage) are read through callbacks at scrape time instead of being kept
+up to date on every event.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# Seconds; covers sub-millisecond handlers up to a slow commit
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labels
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class _Value(Metric):
+    """
+    Counter or gauge. Values are set on the hot path, or computed at scrape
+    time by `collect`, which returns the value (no labels) or
+    (labels, value) pairs.
+    """
+
+    def __init__(self, name, help, labels=(), collect: Callable | None = None):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        if self.collect is not None:
+            result = self.collect()
+            items: Iterable = result if self.labelnames else [((), result)]
+        else:
+            items = list(self.values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Counter(_Value):
+    """Monotonic counter. inc() takes label values in labelnames order."""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(_Value):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class _HistogramChild:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, size: int):
+        # counts[i] is per bucket, not cumulative; the last slot is +Inf
+        self.counts = [0] * size
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.children: dict[tuple, _HistogramChild] = {}
+
+    def observe(self, value: float, *labels):
+        child = self.children.get(labels)
+        if child is None:
+            child = self.children[labels] = _HistogramChild(len(self.buckets) + 1)
+        child.counts[bisect_left(self.buckets, value)] += 1
+        child.sum += value
+
+    def time(self, *labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        bounds = self.buckets + (float("inf"),)
+        for labels, child in list(self.children.items()):
+            total = 0
+            for bound, count in zip(bounds, child.counts):
+                total += count
+                le = f'le="{_number(float(bound))}"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {child.sum!r}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {total}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), collect=None) -> Counter:
+        return self.register(Counter(name, help, labels, collect))
+
+    def gauge(self, name, help, labels=(), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# -------------------------
+# HTTP
+# -------------------------
+http_requests = registry.histogram(
+    "flames_http_request_duration_seconds",
+    "HTTP request latency by route template.",
+    labels=("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request. Labels use the route template ("/nodes/{node_id}"),
+    not the raw path, so the number of series stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_requests.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                status,
+            )
+
+
+# -------------------------
+# Database
+# -------------------------
+db_commit = registry.histogram(
+    "flames_db_commit_seconds",
+    "Time spent in Session.commit().",
+)
+db_pool_checkouts = registry.counter(
+    "flames_db_pool_checkouts_total",
+    "Connections checked out of the SQLAlchemy pool.",
+)
+db_pool_connects = registry.counter(
+    "flames_db_pool_connects_total",
+    "New DBAPI connections opened; overflow=true when beyond pool_size.",
+    labels=("overflow",),
+)
+db_pool_invalidated = registry.counter(
+    "flames_db_pool_invalidated_total",
+    "Pooled connections invalidated (failed pre-ping, disconnects).",
+)
+
+
+# -------------------------
+# Ingest
+# -------------------------
+readings_by_node = registry.counter(
+    "flames_readings_total",
+    "Readings accepted per node, after de-duplication.",
+    labels=("node",),
+)
+ingest_flush = registry.histogram(
+    "flames_ingest_flush_seconds",
+    "Time to write one telemetry batch, including retries.",
+)
+ingest_rows = registry.counter(
+    "flames_ingest_rows_written_total",
+    "Telemetry rows handed to the database by the writer.",
+)
+ingest_rejected = registry.counter(
+    "flames_ingest_rows_rejected_total",
+    "Telemetry rows the database refused, dropped after splitting their batch.",
+)
+archive_rows = registry.counter(
+    "flames_archive_rows_total",
+    "Telemetry rows moved from the database into archive files.",
+)
+
+
+# -------------------------
+# WebSocket
+# -------------------------
+ws_broadcast = registry.histogram(
+    "flames_ws_broadcast_seconds",
+    "Time to encode, publish and route one broadcast.",
+    labels=("type",),
+)
+ws_connects = registry.counter(
+    "flames_ws_connects_total",
+    "WebSocket connections by how they caught up: snapshot or resume.",
+    labels=("mode",),
+)
@@ -0,0 +1,332 @@
+"""
+Versioned schema migrations.
+
+Each migration is applied once, in order, and recorded in the
+schema_migrations table. Steps are written to be safe on databases whose
+tables were created by hand before this module existed: they inspect the
+live schema and only create what is missing.
+
+    python -m app.migrations upgrade          # apply pending migrations
+    python -m app.migrations status           # list applied / pending
+    python -m app.migrations explain          # check dashboard queries use indexes
+    python -m app.migrations rotate --days 30 # move old telemetry to the cold table
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table,
+    delete, inspect, insert, select, text
+)
+
+from app.models import (
+    Incident, Telemetry, TelemetryCold, TelemetryRollup, User
+)
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    "schema_migrations", metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(100), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+# -------------------------
+# Helpers
+# -------------------------
+def _create_table(conn, table):
+    table.create(bind=conn, checkfirst=True)
+
+
+def _create_index(conn, table, name):
+    existing = {ix["name"] for ix in inspect(conn).get_indexes(table.name)}
+    if name in existing:
+        return
+    index = next(ix for ix in table.indexes if ix.name == name)
+    index.create(bind=conn)
+
+
+def _create_unique(conn, table, name):
+    inspector = inspect(conn)
+    existing = {uq["name"] for uq in inspector.get_unique_constraints(table.name)}
+    # MySQL reports unique keys as indexes as well
+    existing |= {ix["name"] for ix in inspector.get_indexes(table.name) if ix.get("unique")}
+    if name in existing:
+        return
+
+    constraint = next(
+        c for c in table.constraints if getattr(c, "name", None) == name
+    )
+    columns = [c.name for c in constraint.columns]
+    # SQLite can't ALTER TABLE ADD CONSTRAINT; a unique index is equivalent
+    conn.execute(text(
+        f"CREATE UNIQUE INDEX {name} ON {table.name} ({', '.join(columns)})"
+    ))
+
+
+def _add_column(conn, table, name):
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    if name in existing:
+        return
+    column_type = table.c[name].type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"))
+
+
+# -------------------------
+# Migrations
+# -------------------------
+def m001_baseline(conn):
+    _create_table(conn, Telemetry.__table__)
+    _create_table(conn, User.__table__)
+
+
+def m002_incidents_and_rollups(conn):
+    _create_table(conn, Incident.__table__)
+    _create_table(conn, TelemetryRollup.__table__)
+
+
+def m003_telemetry_indexes(conn):
+    table = Telemetry.__table__
+    _create_index(conn, table, "ix_telemetry_node_received_at")
+    _create_index(conn, table, "ix_telemetry_received_at")
+
+
+def m004_telemetry_dedup_key(conn):
+    # Keep the first copy of every (node, session, seq) before adding the
+    # key. Rows without session/seq are never considered duplicates.
+    conn.execute(text("""
+        DELETE FROM telemetry
+        WHERE session IS NOT NULL AND seq IS NOT NULL
+          AND id NOT IN (
+            SELECT id FROM (
+                SELECT MIN(id) AS id FROM telemetry
+                WHERE session IS NOT NULL AND seq IS NOT NULL
+                GROUP BY node, session, seq
+            ) AS keep
+          )
+    """))
+    _create_unique(conn, Telemetry.__table__, "uq_telemetry_packet")
+
+
+def m005_telemetry_cold(conn):
+    _create_table(conn, TelemetryCold.__table__)
+
+
+def m006_telemetry_gateways(conn):
+    _add_column(conn, Telemetry.__table__, "gateways")
+    _add_column(conn, TelemetryCold.__table__, "gateways")
+
+
+def m007_telemetry_cold_received_at(conn):
+    _create_index(conn, TelemetryCold.__table__, "ix_telemetry_cold_received_at")
+
+
+MIGRATIONS = [
+    (1, "baseline", m001_baseline),
+    (2, "incidents_and_rollups", m002_incidents_and_rollups),
+    (3, "telemetry_indexes", m003_telemetry_indexes),
+    (4, "telemetry_dedup_key", m004_telemetry_dedup_key),
+    (5, "telemetry_cold", m005_telemetry_cold),
+    (6, "telemetry_gateways", m006_telemetry_gateways),
+    (7, "telemetry_cold_received_at", m007_telemetry_cold_received_at),
+]
+
+
+def applied_versions(conn) -> set[int]:
+    schema_migrations.create(bind=conn, checkfirst=True)
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade(engine) -> list[str]:
+    """Apply pending migrations; returns the names of those applied."""
+    applied = []
+
+    with engine.connect() as conn:
+        mysql = engine.dialect.name == "mysql"
+        if mysql:
+            # Several workers may start at once; only one migrates
+            conn.execute(text("SELECT GET_LOCK('flames_migrations', 60)"))
+        try:
+            done = applied_versions(conn)
+            conn.commit()
+
+            for version, name, step in MIGRATIONS:
+                if version in done:
+                    continue
+                step(conn)
+                conn.execute(insert(schema_migrations).values(
+                    version=version, name=name, applied_at=datetime.utcnow()
+                ))
+                conn.commit()
+                applied.append(name)
+        finally:
+            if mysql:
+                conn.execute(text("SELECT RELEASE_LOCK('flames_migrations')"))
+
+    return applied
+
+
+# -------------------------
+# Hot/cold split
+# -------------------------
+def rotate_cold(engine, before: datetime, chunk: int = 5000) -> int:
+    """
+    Move telemetry rows older than `before` into telemetry_cold, a chunk
+    per transaction so live ingest never waits on a long lock.
+    """
+    hot, cold = Telemetry.__table__, TelemetryCold.__table__
+    columns = [c.name for c in hot.columns]
+    moved = 0
+
+    while True:
+        with engine.begin() as conn:
+            ids = list(conn.execute(
+                select(hot.c.id)
+                .where(hot.c.received_at < before)
+                .order_by(hot.c.received_at)
+                .limit(chunk)
+            ).scalars())
+            if not ids:
+                return moved
+
+            conn.execute(
+                insert(cold).from_select(
+                    columns,
+                    select(*[hot.c[c] for c in columns]).where(hot.c.id.in_(ids))
+                )
+            )
+            conn.execute(delete(hot).where(hot.c.id.in_(ids)))
+            moved += len(ids)
+
+
+# -------------------------
+# Index usage check
+# -------------------------
+def dashboard_queries():
+    from app import rollups, state
+
+    now = datetime.utcnow()
+    return {
+        "nodes_latest": state.latest_statement(),
+        "node_history_raw": rollups.raw_statement("node", now - timedelta(hours=1), now),
+        "node_history_rollup": rollups.rollup_statement(
+            "node", now - timedelta(days=7), now, "hour"
+        ),
+        "node_last_reading": (
+            select(Telemetry)
+            .where(Telemetry.node == "node")
+            .order_by(Telemetry.received_at.desc())
+            .limit(1)
+        ),
+        "open_incidents": select(Incident).where(Incident.status == "open"),
+    }
+
+
+def _plan(conn, stmt) -> list[str]:
+    compiled = stmt.compile(dialect=conn.dialect)
+    params = compiled.construct_params()
+
+    if conn.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+
+    if compiled.positional:
+        args = tuple(params[name] for name in compiled.positiontup)
+    else:
+        args = params
+
+    result = conn.exec_driver_sql(prefix + str(compiled), args)
+
+    if conn.dialect.name == "sqlite":
+        return [row[-1] for row in result]
+    return [
+        " ".join(f"{k}={v}" for k, v in row._mapping.items() if v is not None)
+        for row in result
+    ]
+
+
+def _problems(dialect: str, plan: list[str]) -> list[str]:
+    # Scanning a derived table (a grouped subquery) is expected; scanning a
+    # real table without an index is not.
+    tables = set(Telemetry.metadata.tables)
+    problems = []
+    for line in plan:
+        if dialect == "sqlite":
+            words = line.split()
+            if words[:1] == ["SCAN"] and words[1] in tables and "INDEX" not in words:
+                problems.append(line)
+            if "USE TEMP B-TREE" in line:
+                problems.append(line)
+        else:
+            if "table=<" in line:
+                continue
+            if "type=ALL" in line.split() or "Using filesort" in line:
+                problems.append(line)
+    return problems
+
+
+def explain(engine) -> list[dict]:
+    """EXPLAIN every dashboard query and flag full scans and filesorts."""
+    report = []
+    with engine.connect() as conn:
+        for name, stmt in dashboard_queries().items():
+            plan = _plan(conn, stmt)
+            problems = _problems(engine.dialect.name, plan)
+            report.append({
+                "query": name,
+                "ok": not problems,
+                "plan": plan,
+                "problems": problems,
+            })
+    return report
+
+
+# -------------------------
+# CLI
+# -------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.migrations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("upgrade")
+    sub.add_parser("status")
+    sub.add_parser("explain")
+    rotate = sub.add_parser("rotate")
+    rotate.add_argument("--days", type=float, required=True)
+    rotate.add_argument("--chunk", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    from app.database import engine
+
+    if args.command == "upgrade":
+        for name in upgrade(engine):
+            print("applied", name)
+        return 0
+
+    if args.command == "status":
+        with engine.connect() as conn:
+            done = applied_versions(conn)
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:03d} {name:30} {'applied' if version in done else 'pending'}")
+        return 0
+
+    if args.command == "explain":
+        failed = 0
+        for entry in explain(engine):
+            print(f"[{'ok' if entry['ok'] else 'FAIL'}] {entry['query']}")
+            for line in entry["plan"]:
+                print("    ", line)
+            failed += not entry["ok"]
+        return 1 if failed else 0
+
+    if args.command == "rotate":
+        before = datetime.utcnow() - timedelta(days=args.days)
+        print("moved", rotate_cold(engine, before, args.chunk), "rows")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
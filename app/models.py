@@ -1,18 +1,18 @@
 from sqlalchemy import (
     Column, BigInteger, Integer, String,
-    Float, DateTime
+    Float, DateTime, Index, UniqueConstraint
 )
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
 Base = declarative_base()
 
+# SQLite only autoincrements INTEGER PRIMARY KEY columns
+BigId = BigInteger().with_variant(Integer, "sqlite")
 
-class Telemetry(Base):
-    __tablename__ = "telemetry"
-    __table_args__ = {"extend_existing": True}
 
-    id = Column(BigInteger, primary_key=True, autoincrement=True)
+class TelemetryColumns:
+    id = Column(BigId, primary_key=True, autoincrement=True)
     node = Column(String(50))
     session = Column(BigInteger)
     seq = Column(Integer)
@@ -29,15 +29,88 @@ class Telemetry(Base):
     gateway = Column(String(50))
     rssi = Column(Integer)
     snr = Column(Float)
+    # Every gateway that heard this packet, comma separated (app/dedup.py)
+    gateways = Column(String(255))
 
     received_at = Column(DateTime)
+
+
+class Telemetry(TelemetryColumns, Base):
+    __tablename__ = "telemetry"
+    __table_args__ = (
+        Index("ix_telemetry_node_received_at", "node", "received_at"),
+        Index("ix_telemetry_received_at", "received_at"),
+        UniqueConstraint("node", "session", "seq", name="uq_telemetry_packet"),
+        {"extend_existing": True},
+    )
+
+
+# Cold tier: rows older than the hot window, same layout (see app/migrations.py)
+class TelemetryCold(TelemetryColumns, Base):
+    __tablename__ = "telemetry_cold"
+    __table_args__ = (
+        Index("ix_telemetry_cold_node_received_at", "node", "received_at"),
+        # The archive job moves the oldest rows first (app/archive.py)
+        Index("ix_telemetry_cold_received_at", "received_at"),
+        {"extend_existing": True},
+    )
     
 
+class TelemetryRollup(Base):
+    __tablename__ = "telemetry_rollup"
+    __table_args__ = {"extend_existing": True}
+
+    resolution = Column(String(6), primary_key=True)
+    node = Column(String(50), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+
+    count = Column(Integer, nullable=False, default=0)
+
+    temp_n = Column(Integer, nullable=False, default=0)
+    temp_sum = Column(Float)
+    temp_min = Column(Float)
+    temp_max = Column(Float)
+
+    hum_n = Column(Integer, nullable=False, default=0)
+    hum_sum = Column(Float)
+    hum_min = Column(Float)
+    hum_max = Column(Float)
+
+    smoke_n = Column(Integer, nullable=False, default=0)
+    smoke_sum = Column(Float)
+    smoke_min = Column(Integer)
+    smoke_max = Column(Integer)
+
+    flame_max = Column(Integer)
+
+
+class Incident(Base):
+    __tablename__ = "incidents"
+    __table_args__ = {"extend_existing": True}
+
+    id = Column(BigId, primary_key=True, autoincrement=True)
+    node = Column(String(50), index=True)
+    severity = Column(String(10))
+    status = Column(String(10), index=True)
+    rules = Column(String(255))
+
+    lat = Column(Float)
+    lon = Column(Float)
+
+    peak_temp = Column(Float)
+    peak_smoke = Column(Integer)
+    flame = Column(Integer)
+
+    opened_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    closed_at = Column(DateTime, nullable=True)
+
+
 class User(Base):
     __tablename__ = "users"
     __table_args__ = {"extend_existing": True}
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigId, primary_key=True)
     username = Column(String(50), unique=True, nullable=False)
     organization = Column(String(100), nullable=False)
     password_hash = Column(String(255), nullable=False)
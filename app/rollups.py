@@ -0,0 +1,225 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select, union_all
+from sqlalchemy.dialects import mysql, sqlite
+
+from app import archive
+from app.models import Telemetry, TelemetryCold, TelemetryRollup
+
+
+# Resolution name -> bucket width, coarsest first
+RESOLUTIONS = {
+    "day": timedelta(days=1),
+    "hour": timedelta(hours=1),
+    "minute": timedelta(minutes=1),
+}
+
+# Widest window that may still be answered from raw telemetry rows
+HISTORY_RAW_WINDOW = timedelta(
+    seconds=float(os.getenv("HISTORY_RAW_WINDOW", str(6 * 3600)))
+)
+HISTORY_MAX_POINTS = int(os.getenv("HISTORY_MAX_POINTS", "5000"))
+
+AGG_FIELDS = ("temp", "hum", "smoke")
+
+
+def to_utc(ts: datetime) -> datetime:
+    """Naive UTC, the form stored in DateTime columns."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def bucket(ts: datetime, resolution: str) -> datetime:
+    ts = to_utc(ts)
+    if resolution == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# -------------------------
+# Incremental maintenance
+# -------------------------
+def aggregate(rows: list[dict]) -> list[dict]:
+    """Fold a batch of readings into one partial rollup per (resolution, node, bucket)."""
+    acc: dict[tuple, dict] = {}
+
+    for row in rows:
+        for resolution in RESOLUTIONS:
+            key = (resolution, row["node"], bucket(row["received_at"], resolution))
+            agg = acc.get(key)
+            if agg is None:
+                agg = acc[key] = {
+                    "resolution": resolution,
+                    "node": row["node"],
+                    "bucket": key[2],
+                    "count": 0,
+                    "flame_max": None,
+                }
+                for f in AGG_FIELDS:
+                    agg[f"{f}_n"] = 0
+                    agg[f"{f}_sum"] = None
+                    agg[f"{f}_min"] = None
+                    agg[f"{f}_max"] = None
+
+            agg["count"] += 1
+
+            for f in AGG_FIELDS:
+                value = row.get(f)
+                if value is None:
+                    continue
+                agg[f"{f}_n"] += 1
+                if agg[f"{f}_sum"] is None:
+                    agg[f"{f}_sum"] = agg[f"{f}_min"] = agg[f"{f}_max"] = value
+                else:
+                    agg[f"{f}_sum"] += value
+                    agg[f"{f}_min"] = min(agg[f"{f}_min"], value)
+                    agg[f"{f}_max"] = max(agg[f"{f}_max"], value)
+
+            flame = row.get("flame")
+            if flame is not None and (agg["flame_max"] is None or flame > agg["flame_max"]):
+                agg["flame_max"] = flame
+
+    return list(acc.values())
+
+
+async def apply(db, rows: list[dict]):
+    """Merge a batch into the rollup table with a single upsert, in db's transaction."""
+    partials = aggregate(rows)
+    if not partials:
+        return
+
+    dialect = db.bind.dialect.name
+    if dialect == "mysql":
+        stmt = mysql.insert(TelemetryRollup).values(partials)
+        new = stmt.inserted
+        least, greatest = func.least, func.greatest
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(TelemetryRollup).values(partials)
+        new = stmt.excluded
+        least, greatest = func.min, func.max
+    else:
+        raise NotImplementedError(f"rollups are not supported on {dialect}")
+
+    t = TelemetryRollup.__table__.c
+
+    def merge(combine, col):
+        # NULL-safe: LEAST(NULL, x) is NULL on both backends
+        return func.coalesce(combine(t[col], new[col]), t[col], new[col])
+
+    values = {"count": t["count"] + new["count"]}
+    for f in AGG_FIELDS:
+        values[f"{f}_n"] = t[f"{f}_n"] + new[f"{f}_n"]
+        values[f"{f}_sum"] = merge(lambda a, b: a + b, f"{f}_sum")
+        values[f"{f}_min"] = merge(least, f"{f}_min")
+        values[f"{f}_max"] = merge(greatest, f"{f}_max")
+    values["flame_max"] = merge(greatest, "flame_max")
+
+    if dialect == "mysql":
+        stmt = stmt.on_duplicate_key_update(**values)
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["resolution", "node", "bucket"],
+            set_=values
+        )
+
+    await db.execute(stmt)
+
+
+# -------------------------
+# Queries
+# -------------------------
+def pick_resolution(start: datetime, end: datetime, points: int) -> str:
+    """
+    Coarsest rollup that yields at least `points` buckets without going
+    over HISTORY_MAX_POINTS; otherwise raw for short windows, else the
+    finest rollup that fits.
+    """
+    span = end - start
+    for resolution, width in RESOLUTIONS.items():
+        if points <= span / width <= HISTORY_MAX_POINTS:
+            return resolution
+    if span <= HISTORY_RAW_WINDOW:
+        return "raw"
+    for resolution, width in reversed(RESOLUTIONS.items()):
+        if span / width <= HISTORY_MAX_POINTS:
+            return resolution
+    return "day"
+
+
+def _avg(total, n):
+    return total / n if n else None
+
+
+def raw_statement(node: str, start: datetime, end: datetime):
+    # Rows moved by `migrations rotate` live in telemetry_cold, same ids
+    parts = [
+        select(t.c.id, t.c.received_at, t.c.temp, t.c.hum, t.c.smoke, t.c.flame)
+        .where(t.c.node == node, t.c.received_at >= start, t.c.received_at < end)
+        for t in (Telemetry.__table__, TelemetryCold.__table__)
+    ]
+    rows = union_all(*parts).subquery()
+    return (
+        select(rows)
+        .order_by(rows.c.received_at)
+        # One extra row tells history() the result was cut short
+        .limit(HISTORY_MAX_POINTS + 1)
+    )
+
+
+def rollup_statement(node: str, start: datetime, end: datetime, resolution: str):
+    return (
+        select(TelemetryRollup)
+        .where(
+            TelemetryRollup.resolution == resolution,
+            TelemetryRollup.node == node,
+            TelemetryRollup.bucket >= bucket(start, resolution),
+            TelemetryRollup.bucket < end
+        )
+        .order_by(TelemetryRollup.bucket)
+        .limit(HISTORY_MAX_POINTS + 1)
+    )
+
+
+async def history(db, node: str, start: datetime, end: datetime,
+                  resolution: str) -> tuple[list[dict], bool]:
+    """Points oldest first, and whether more than HISTORY_MAX_POINTS matched."""
+    if resolution == "raw":
+        # Rows past the hot window live in archive files (app/archive.py)
+        archived = await asyncio.to_thread(archive.store.read, node, start, end)
+        ids = {r["id"] for r in archived}
+        rows = archived + [
+            r._asdict() for r in await db.execute(raw_statement(node, start, end))
+            if r.id not in ids
+        ]
+        if archived:
+            rows.sort(key=lambda r: r["received_at"])
+        truncated = len(rows) > HISTORY_MAX_POINTS
+        return [
+            {
+                "t": r["received_at"],
+                "temp": r["temp"],
+                "hum": r["hum"],
+                "smoke": r["smoke"],
+                "flame": r["flame"],
+            }
+            for r in rows[:HISTORY_MAX_POINTS]
+        ], truncated
+
+    rows = (await db.execute(rollup_statement(node, start, end, resolution))).scalars().all()
+    truncated = len(rows) > HISTORY_MAX_POINTS
+
+    points = []
+    for r in rows[:HISTORY_MAX_POINTS]:
+        point = {"t": r.bucket, "count": r.count}
+        for f in AGG_FIELDS:
+            point[f"{f}_min"] = getattr(r, f"{f}_min")
+            point[f"{f}_max"] = getattr(r, f"{f}_max")
+            point[f"{f}_avg"] = _avg(getattr(r, f"{f}_sum"), getattr(r, f"{f}_n"))
+        point["flame_max"] = r.flame_max
+        points.append(point)
+    return points, truncated
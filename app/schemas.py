@@ -1,9 +1,13 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import datetime
 
 
 class TelemetryIn(BaseModel):
-    node: str
+    # NaN/Infinity would break the spatial index and MySQL
+    model_config = ConfigDict(allow_inf_nan=False)
+
+    # Lengths match the telemetry columns
+    node: str = Field(max_length=50)
     session: int | None = None
     seq: int | None = None
 
@@ -16,7 +20,7 @@ class TelemetryIn(BaseModel):
     flame: int | None = None
     smoke: int | None = None
 
-    gateway: str | None = None
+    gateway: str | None = Field(None, max_length=50)
     rssi: int | None = None
     snr: float | None = None
 
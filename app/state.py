@@ -1,2 +1,151 @@
+import os
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select
+
+from app import metrics
+from app.geo import node_index
+from app.models import Telemetry
+
+# A node is reported offline when nothing was heard from it for this long
+NODE_OFFLINE_AFTER = float(os.getenv("NODE_OFFLINE_AFTER", "120"))
+
+TELEMETRY_FIELDS = (
+    "node", "session", "seq", "temp", "hum", "lat", "lon",
+    "flame", "smoke", "gateway", "rssi", "snr", "gateways", "received_at",
+)
+
+# node id -> {"row": full reading, "view": dashboard shape, "last_seen": epoch}
 nodes: dict[str, dict] = {}
-incidents: list[dict] = []
+
+
+def _epoch(ts: datetime) -> float:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+def _view(row: dict, previous: dict | None = None) -> dict:
+    lat, lon = row["lat"], row["lon"]
+    if (lat is None or lon is None) and previous is not None:
+        # A reading without a fix leaves the node where it was last placed,
+        # matching node_index
+        lat, lon = previous["lat"], previous["lon"]
+    return {
+        "node": row["node"],
+        "lat": lat,
+        "lon": lon,
+        "temp": row["temp"],
+        "hum": row["hum"],
+        "smoke": row["smoke"],
+        "flame": bool(row["flame"]),
+        "received_at": row["received_at"],
+    }
+
+
+def update_node(row: dict, last_seen: float | None = None):
+    """Write-through on ingest; older out-of-order readings are ignored."""
+    current = nodes.get(row["node"])
+    # received_at is naive UTC everywhere (normalized in main.enqueue)
+    if current is not None and row["received_at"] < current["row"]["received_at"]:
+        return
+
+    nodes[row["node"]] = {
+        "row": row,
+        "view": _view(row, current["view"] if current is not None else None),
+        "last_seen": time.time() if last_seen is None else last_seen,
+    }
+
+    if row["lat"] is not None and row["lon"] is not None:
+        node_index.update(row["node"], row["lat"], row["lon"])
+
+
+def latest_statement():
+    latest = (
+        select(
+            Telemetry.node,
+            func.max(Telemetry.received_at).label("max_time")
+        )
+        .group_by(Telemetry.node)
+        .subquery()
+    )
+
+    columns = [getattr(Telemetry, f) for f in TELEMETRY_FIELDS]
+    return select(*columns).join(
+        latest,
+        (Telemetry.node == latest.c.node)
+        & (Telemetry.received_at == latest.c.max_time)
+    )
+
+
+def revert_node(rejected: dict, stored: dict):
+    """The writer skipped `rejected` as a copy of `stored`; stop showing it."""
+    entry = nodes.get(rejected["node"])
+    if entry is not None and entry["row"] is rejected:
+        entry["row"] = stored
+        entry["view"] = _view(stored, entry["view"])
+
+
+async def load_nodes(db):
+    """Fill the store from the latest row per node, in a single query."""
+    result = await db.execute(latest_statement())
+    nodes.clear()
+    node_index.clear()
+    for r in result.mappings():
+        row = dict(r)
+        update_node(row, last_seen=_epoch(row["received_at"]))
+
+
+def _health(entry: dict, now: float) -> dict:
+    age = max(0.0, now - entry["last_seen"])
+    return {
+        "online": age <= NODE_OFFLINE_AFTER,
+        "last_seen_s": round(age, 1),
+    }
+
+
+def node_snapshot(node_id: str) -> dict | None:
+    entry = nodes.get(node_id)
+    if entry is None:
+        return None
+    return {**entry["view"], **_health(entry, time.time())}
+
+
+def nodes_snapshot(node_ids=None) -> dict[str, dict]:
+    """Every node, or only node_ids (e.g. from a spatial query)."""
+    now = time.time()
+    if node_ids is None:
+        return {
+            node_id: {**entry["view"], **_health(entry, now)}
+            for node_id, entry in nodes.items()
+        }
+    return {
+        node_id: {**nodes[node_id]["view"], **_health(nodes[node_id], now)}
+        for node_id in node_ids
+        if node_id in nodes
+    }
+
+
+def latest_rows() -> list[dict]:
+    now = time.time()
+    return [
+        {**entry["row"], **_health(entry, now)}
+        for entry in nodes.values()
+    ]
+
+
+def _last_seen_ages():
+    now = time.time()
+    return [
+        ((node_id,), round(max(0.0, now - entry["last_seen"]), 3))
+        for node_id, entry in list(nodes.items())
+    ]
+
+
+metrics.registry.gauge(
+    "flames_node_last_seen_age_seconds",
+    "Seconds since each node was last heard from.",
+    labels=("node",),
+    collect=_last_seen_ages,
+)
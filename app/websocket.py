@@ -1,29 +1,516 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Dict
+
 from fastapi import WebSocket
-from typing import List, Dict
+
+from app import encoding, metrics
+from app.bus import Event, create_bus
+
+logger = logging.getLogger(__name__)
+
+
+# Frames buffered per client before the overflow policy kicks in
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+# drop_oldest | coalesce | disconnect
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "coalesce")
+# Upper bound for the per-client "max_rate" a subscriber may ask for
+WS_MAX_RATE = float(os.getenv("WS_MAX_RATE", "20"))
+# Recent events kept for clients that reconnect with ?since=<seq>
+WS_REPLAY_SIZE = int(os.getenv("WS_REPLAY_SIZE", "1024"))
+# How long one encoded snapshot is shared by clients connecting together
+WS_SNAPSHOT_TTL = float(os.getenv("WS_SNAPSHOT_TTL", "1"))
+
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+def encode(message: Dict) -> str:
+    return encoding.dumps_text(message)
+
+
+def _packet(event: Event):
+    """(session, seq) of a node_update, or None when the reading has none."""
+    data = event.message["data"]
+    if data.get("session") is None or data.get("seq") is None:
+        return None
+    return (data["session"], data["seq"])
+
+
+class Subscription:
+    """
+    What a client asked to receive. The default matches every event.
+
+    Control message sent by the client:
+
+        {"type": "subscribe",
+         "nodes": ["node-1", "node-2"],          # optional
+         "bbox": [min_lat, min_lon, max_lat, max_lon],  # optional
+         "incidents_only": false,                # optional
+         "max_rate": 2,                          # node update bursts per second
+         "deltas": true}                         # only send changed fields
+    """
+
+    def __init__(self, nodes=None, bbox=None, incidents_only=False,
+                 max_rate=None, deltas=False):
+        self.nodes: set[str] | None = nodes
+        self.bbox: tuple[float, float, float, float] | None = bbox
+        self.incidents_only = incidents_only
+        self.max_rate = max_rate
+        self.deltas = deltas
+
+    @classmethod
+    def from_message(cls, msg: Dict) -> "Subscription":
+        nodes = msg.get("nodes")
+        if nodes is not None:
+            if not isinstance(nodes, list) or not all(isinstance(n, str) for n in nodes):
+                raise ValueError("nodes must be a list of node ids")
+            nodes = set(nodes)
+
+        bbox = msg.get("bbox")
+        if bbox is not None:
+            if not isinstance(bbox, list) or len(bbox) != 4:
+                raise ValueError("bbox must be [min_lat, min_lon, max_lat, max_lon]")
+            min_lat, min_lon, max_lat, max_lon = (float(v) for v in bbox)
+            if min_lat > max_lat or min_lon > max_lon:
+                raise ValueError("bbox minimum is greater than maximum")
+            bbox = (min_lat, min_lon, max_lat, max_lon)
+
+        max_rate = msg.get("max_rate")
+        if max_rate is not None:
+            max_rate = float(max_rate)
+            if max_rate <= 0:
+                raise ValueError("max_rate must be positive")
+            max_rate = min(max_rate, WS_MAX_RATE)
+
+        return cls(
+            nodes=nodes,
+            bbox=bbox,
+            incidents_only=bool(msg.get("incidents_only", False)),
+            max_rate=max_rate,
+            deltas=bool(msg.get("deltas", False)),
+        )
+
+    def matches(self, kind: str, node: str | None, position) -> bool:
+        if self.incidents_only and kind == "node_update":
+            return False
+        if self.nodes is not None and node not in self.nodes:
+            return False
+        if self.bbox is not None:
+            if position is None:
+                return False
+            lat, lon = position
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+                return False
+        return True
+
+    def describe(self) -> Dict:
+        return {
+            "nodes": sorted(self.nodes) if self.nodes is not None else None,
+            "bbox": list(self.bbox) if self.bbox is not None else None,
+            "incidents_only": self.incidents_only,
+            "max_rate": self.max_rate,
+            "deltas": self.deltas,
+        }
+
+
+class Client:
+    """
+    One connected socket with its own bounded send queue.
+
+    Pending frames live in an OrderedDict. A node_update replaces an older,
+    not yet sent update for the same node when the policy is "coalesce" or
+    the client asked for a max_rate; otherwise every frame is queued under
+    a unique key.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, ws: WebSocket, maxsize: int, policy: str):
+        self.id = next(self._ids)
+        self.ws = ws
+        self.maxsize = maxsize
+        self.policy = policy
+        self.subscription = Subscription()
+        self.pending: OrderedDict = OrderedDict()
+        self._seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.task: asyncio.Task | None = None
+
+        # node -> last data sent to this client, for delta frames
+        self.last_sent: Dict[str, Dict] = {}
+
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_lag = 0.0
+
+    def subscribe(self, subscription: Subscription):
+        self.subscription = subscription
+        self.last_sent.clear()
+
+    def push(self, key, event: Event):
+        if self.closing:
+            return
+
+        now = time.monotonic()
+
+        coalesce = self.policy == "coalesce" or self.subscription.max_rate
+        if key[0] != "node" or not coalesce:
+            key = next(self._seq)
+        elif key in self.pending:
+            # Keep the original queue position and enqueue time, newest data
+            _, queued_at = self.pending[key]
+            self.pending[key] = (event, queued_at)
+            self.coalesced += 1
+            return
+
+        if len(self.pending) >= self.maxsize:
+            if self.policy == "disconnect":
+                self.closing = True
+                self.wakeup.set()
+                return
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+        self.pending[key] = (event, now)
+        self.wakeup.set()
+
+    def send_now(self, message: Dict):
+        self.push(("control",), Event("control", None, None, None, encode(message), message))
+
+    def lag(self) -> float:
+        if not self.pending:
+            return 0.0
+        _, queued_at = next(iter(self.pending.values()))
+        return time.monotonic() - queued_at
+
+    def stats(self) -> Dict:
+        return {
+            "id": self.id,
+            "queued": len(self.pending),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "lag_s": round(self.lag(), 3),
+            "max_lag_s": round(self.max_lag, 3),
+            "connected_s": round(time.time() - self.connected_at, 1),
+            "subscription": self.subscription.describe(),
+        }
+
+    def _render(self, event: Event) -> str | None:
+        if not (self.subscription.deltas and event.kind == "node_update"):
+            return event.frame
+
+        data = event.message["data"]
+        previous = self.last_sent.get(data["node"])
+        self.last_sent[data["node"]] = data
+
+        if previous is None:
+            return event.frame
+
+        changed = {
+            k: v for k, v in data.items()
+            if k not in previous or previous[k] != v
+        }
+        if not changed:
+            return None
+        changed["node"] = data["node"]
+
+        return encode({
+            "seq": event.seq, "type": "node_update", "delta": True, "data": changed
+        })
+
+    async def run(self, manager: "WebSocketManager"):
+        loop = asyncio.get_running_loop()
+        next_burst = 0.0
+
+        try:
+            while not self.closing:
+                if not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+
+                max_rate = self.subscription.max_rate
+                if max_rate:
+                    # Let node updates pile up (coalesced) until the next burst
+                    delay = next_burst - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_burst = loop.time() + 1 / max_rate
+
+                    burst = list(self.pending.values())
+                    self.pending.clear()
+                else:
+                    burst = [self.pending.popitem(last=False)[1]]
+
+                for event, queued_at in burst:
+                    text = self._render(event)
+                    if text is None:
+                        continue
+                    await self.ws.send_text(text)
+                    self.sent += 1
+                    self.max_lag = max(self.max_lag, time.monotonic() - queued_at)
+
+            # Fell too far behind under the "disconnect" policy
+            await self.ws.close(code=1013)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.debug("websocket client %d send failed", self.id)
+        finally:
+            manager.clients.pop(self.ws, None)
+
 
 class WebSocketManager:
-    def __init__(self):
-        self.clients: List[WebSocket] = []
+    """
+    Every event delivered on this worker gets the next `seq`, stamped into
+    its frame. A new client first receives a snapshot frame carrying the
+    stream id and current seq; a client reconnecting with
+    /ws?stream=<id>&since=<seq> instead gets the events it missed, or a
+    fresh snapshot when they are no longer buffered. Each worker (and each
+    restart) is its own stream.
+    """
+
+    def __init__(self, maxsize: int = WS_QUEUE_SIZE, policy: str = WS_OVERFLOW_POLICY,
+                 replay_size: int = WS_REPLAY_SIZE):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown websocket overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.clients: Dict[WebSocket, Client] = {}
+        # Last known position per node, for bbox subscriptions
+        self.positions: Dict[str, tuple[float, float]] = {}
+        # Newest node_update delivered per node
+        self.node_last: Dict[str, Event] = {}
+        self._keys = itertools.count()
 
-    async def connect(self, ws: WebSocket):
+        # Carries events to the other workers (app/bus.py)
+        self.bus = create_bus()
+        self.origin = uuid.uuid4().hex
+        # Called with every event published by another worker
+        self.remote_listeners: list = []
+        self.stale = 0
+        self.copies = 0
+
+        self.seq = 0
+        self.history: deque = deque(maxlen=replay_size)
+        # Returns the snapshot payload; set by app/main.py
+        self.snapshot = None
+        self._snapshot_cache: tuple[Event, float] | None = None
+
+    async def start(self):
+        await self.bus.start(self.deliver, self.origin)
+
+    async def stop(self):
+        await self.bus.stop()
+
+    async def connect(self, ws: WebSocket, since: int | None = None, stream: str | None = None):
         await ws.accept()
-        self.clients.append(ws)
+        client = Client(ws, self.maxsize, self.policy)
+        self.clients[ws] = client
+        self._catch_up(client, since, stream)
+        client.task = asyncio.create_task(client.run(self))
+
+    def _catch_up(self, client: Client, since: int | None, stream: str | None):
+        """Queue what a new client needs before live events: replay or snapshot."""
+        missed = None
+        if stream == self.origin and since is not None:
+            missed = self._missed(since)
+
+        if missed is None:
+            client.push(("control",), self._snapshot_event())
+            metrics.ws_connects.inc("snapshot")
+            return
+
+        client.send_now({
+            "type": "resumed",
+            "stream": self.origin,
+            "since": since,
+            "seq": self.seq,
+            "replayed": len(missed)
+        })
+        for event in missed:
+            client.push(self._key(event), event)
+        metrics.ws_connects.inc("resume")
+
+    def _missed(self, since: int) -> list[Event] | None:
+        # None when the gap is no longer buffered or would overflow the queue
+        count = self.seq - since
+        if count < 0 or count > len(self.history) or count >= self.maxsize:
+            return None
+        return list(itertools.islice(self.history, len(self.history) - count, None))
+
+    def _snapshot_event(self) -> Event:
+        # Clients reconnecting together (after a deploy) share one encoding
+        now = time.monotonic()
+        if self._snapshot_cache is not None:
+            event, built_at = self._snapshot_cache
+            if event.seq == self.seq and now - built_at < WS_SNAPSHOT_TTL:
+                return event
+
+        message = {
+            "type": "snapshot",
+            "stream": self.origin,
+            "seq": self.seq,
+            "data": self.snapshot() if self.snapshot is not None else {}
+        }
+        event = Event("snapshot", None, None, None, encode(message), message)
+        event.seq = self.seq
+        self._snapshot_cache = (event, now)
+        return event
 
     def disconnect(self, ws: WebSocket):
-        if ws in self.clients:
-            self.clients.remove(ws)
+        client = self.clients.pop(ws, None)
+        if client and client.task:
+            client.task.cancel()
+
+    def handle_control(self, ws: WebSocket, raw: str):
+        """Apply a control message read from the client's socket."""
+        client = self.clients.get(ws)
+        if client is None:
+            return
+
+        try:
+            msg = encoding.loads(raw)
+            if not isinstance(msg, dict):
+                raise ValueError("control message must be a JSON object")
+
+            kind = msg.get("type")
+            if kind == "subscribe":
+                client.subscribe(Subscription.from_message(msg))
+            elif kind == "unsubscribe":
+                client.subscribe(Subscription())
+            else:
+                raise ValueError(f"unknown message type: {kind}")
+        except (ValueError, TypeError) as exc:
+            client.send_now({"type": "error", "detail": str(exc)})
+            return
+
+        client.send_now({
+            "type": "subscribed",
+            "data": client.subscription.describe()
+        })
+
+    def broadcast(self, message: Dict):
+        """
+        Encode once and publish to every worker's clients, this one
+        included. Never awaits network I/O; the per-client sender tasks
+        do the sends.
+        """
+        if not self.clients and self.bus.name == "local" and not self.history.maxlen:
+            # Nobody to send it to or replay it for; the seq is still used
+            # up so a resume from before this event gets a snapshot
+            self.seq += 1
+            return
+
+        started = time.perf_counter()
+        kind = message.get("type")
+        data = message.get("data") or {}
+        node = data.get("node")
+
+        position = None
+        if data.get("lat") is not None and data.get("lon") is not None:
+            position = (data["lat"], data["lon"])
+
+        ts = data.get("received_at")
+        if isinstance(ts, datetime):
+            ts = ts.isoformat()
+
+        self.bus.publish(Event(
+            kind, node, position, ts, encode(message), message, origin=self.origin
+        ))
+        metrics.ws_broadcast.observe(time.perf_counter() - started, kind)
+
+    def deliver(self, event: Event):
+        """Route one event, local or from another worker, to matching clients."""
+        node = event.node
+
+        if event.kind == "node_update" and event.ts is not None:
+            # Readings of a node ingested by different workers can cross on
+            # the bus; never let an older update overwrite a newer one.
+            last = self.node_last.get(node)
+            if last is not None:
+                if event.ts < last.ts:
+                    self.stale += 1
+                    return
+                if self._is_copy(event, last):
+                    self.copies += 1
+                    return
+            self.node_last[node] = event
+
+        self.seq += 1
+        event.seq = self.seq
+        # Splice the seq into the already encoded frame
+        event.frame = '{"seq":%d,%s' % (self.seq, event.frame[1:])
+        self.history.append(event)
+
+        if event.position is not None:
+            self.positions[node] = event.position
+
+        if event.origin != self.origin:
+            for listener in self.remote_listeners:
+                listener(event)
+
+        if not self.clients:
+            return
+
+        position = self.positions.get(node)
+        key = self._key(event)
+
+        for client in list(self.clients.values()):
+            if client.subscription.matches(event.kind, node, position):
+                client.push(key, event)
+
+    @staticmethod
+    def _is_copy(event: Event, last: Event) -> bool:
+        # Gateway copies of one packet can pass the per-worker dedup when
+        # they reach different workers
+        packet = _packet(event)
+        if packet is None:
+            return event.ts == last.ts
+        return packet == _packet(last)
+
+    def _key(self, event: Event):
+        if event.kind == "node_update":
+            return ("node", event.node)
+        return ("event", next(self._keys))
 
-    async def broadcast(self, message: Dict):
-        dead_clients = []
+    def stats(self):
+        return [client.stats() for client in self.clients.values()]
 
-        for client in self.clients:
-            try:
-                await client.send_json(message)
-            except Exception:
-                dead_clients.append(client)
+    def bus_stats(self) -> Dict:
+        return {
+            **self.bus.stats(),
+            "stale_dropped": self.stale,
+            "copies_dropped": self.copies,
+            "seq": self.seq,
+            "replay_buffered": len(self.history),
+        }
 
-        # Clean up dead connections
-        for dc in dead_clients:
-            self.disconnect(dc)
+manager = WebSocketManager()
 
-manager = WebSocketManager()
\ No newline at end of file
+metrics.registry.gauge(
+    "flames_ws_clients",
+    "Connected WebSocket clients on this worker.",
+    collect=lambda: len(manager.clients),
+)
+metrics.registry.counter(
+    "flames_ws_stale_dropped_total",
+    "node_update events dropped because a newer one was already delivered.",
+    collect=lambda: manager.stale,
+)
+metrics.registry.counter(
+    "flames_ws_copies_dropped_total",
+    "node_update events dropped as copies of the last packet delivered for the node.",
+    collect=lambda: manager.copies,
+)
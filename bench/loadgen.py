@@ -0,0 +1,498 @@
+"""
+Load generator and benchmark for the F.L.A.M.E.S backend.
+
+Starts the app under uvicorn against a throwaway SQLite database (or
+targets a running server with --url) and drives it with:
+
+  * N nodes x M gateways POSTing readings to /ingest (or /ingest/batch,
+    or the /ingest/packed variants with --format packed)
+  * K dashboard clients polling /nodes and /incidents
+  * W /ws subscribers measuring ingest -> WebSocket delivery lag
+
+Results are written as JSON (bench/results/ by default) so runs can be
+compared across commits:
+
+    python bench/loadgen.py run --scenario steady
+    python bench/loadgen.py run --scenario fire --workers 2 --out fire.json
+    python bench/loadgen.py compare before.json after.json
+
+Needs httpx and websockets (bench/requirements.txt).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import packed  # noqa: E402
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+SCENARIOS = {
+    # Normal operation: every node reports, a few dashboards are open
+    "steady": {
+        "nodes": 200, "gateways": 2, "rate": 100.0, "duration": 30.0,
+        "batch": 0, "dashboards": 5, "poll_interval": 1.0,
+        "ws_clients": 20, "fire_ratio": 0.0,
+    },
+    # Gateways come back online and flush their backlog in batches
+    "burst": {
+        "nodes": 500, "gateways": 4, "rate": 1000.0, "duration": 15.0,
+        "batch": 50, "dashboards": 5, "poll_interval": 1.0,
+        "ws_clients": 20, "fire_ratio": 0.0,
+    },
+    # A fire front: many nodes alarming while every dashboard watches
+    "fire": {
+        "nodes": 300, "gateways": 2, "rate": 300.0, "duration": 20.0,
+        "batch": 0, "dashboards": 20, "poll_interval": 0.5,
+        "ws_clients": 50, "fire_ratio": 0.3,
+    },
+}
+
+MAX_IN_FLIGHT = 256
+
+
+# -------------------------
+# Measurements
+# -------------------------
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(samples: list[float], duration: float) -> dict:
+    ms = [s * 1000 for s in samples]
+    return {
+        "count": len(ms),
+        "throughput_rps": round(len(ms) / duration, 2) if duration else None,
+        "p50_ms": _round(percentile(ms, 50)),
+        "p95_ms": _round(percentile(ms, 95)),
+        "p99_ms": _round(percentile(ms, 99)),
+        "max_ms": _round(max(ms) if ms else None),
+    }
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+class Recorder:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = {}
+        self.status: dict[str, dict[str, int]] = {}
+        self.delivery_lag: list[float] = []
+        self.ws_messages = 0
+        self.sent_at: dict[tuple, float] = {}
+        self.behind = 0
+
+    def record(self, endpoint: str, elapsed: float, status):
+        self.latency.setdefault(endpoint, []).append(elapsed)
+        counts = self.status.setdefault(endpoint, {})
+        counts[str(status)] = counts.get(str(status), 0) + 1
+
+
+# -------------------------
+# Simulated fleet
+# -------------------------
+class Fleet:
+    def __init__(self, nodes: int, gateways: int, fire_ratio: float, seed: int):
+        rng = random.Random(seed)
+        self.rng = rng
+        self.session = int(time.time())
+        self.nodes = [
+            {
+                "node": f"bench-{i:05d}",
+                "lat": 14.5 + rng.uniform(-0.5, 0.5),
+                "lon": 121.0 + rng.uniform(-0.5, 0.5),
+                "seq": 0,
+                "burning": rng.random() < fire_ratio,
+            }
+            for i in range(nodes)
+        ]
+        self.gateways = [f"bench-gw-{g}" for g in range(gateways)]
+        self._next = 0
+
+    def reading(self) -> dict:
+        node = self.nodes[self._next % len(self.nodes)]
+        self._next += 1
+        node["seq"] += 1
+
+        burning = node["burning"]
+        return {
+            "node": node["node"],
+            "session": self.session,
+            "seq": node["seq"],
+            "temp": round(self.rng.uniform(70, 95) if burning else self.rng.uniform(24, 34), 2),
+            "hum": round(self.rng.uniform(10, 30) if burning else self.rng.uniform(50, 80), 2),
+            "lat": node["lat"],
+            "lon": node["lon"],
+            "flame": 1 if burning else 0,
+            "smoke": self.rng.randint(350, 800) if burning else self.rng.randint(0, 120),
+            "received_at": datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+        }
+
+    def copies(self, reading: dict) -> list[dict]:
+        """The same packet as heard by every gateway."""
+        return [
+            {**reading, "gateway": gw, "rssi": self.rng.randint(-120, -60),
+             "snr": round(self.rng.uniform(-10, 10), 1)}
+            for gw in self.gateways
+        ]
+
+
+# -------------------------
+# Drivers
+# -------------------------
+async def timed_request(client, rec: Recorder, name: str, method: str, path: str, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, path, **kwargs)
+        status = response.status_code
+    except httpx.HTTPError as exc:
+        status = type(exc).__name__
+    rec.record(name, time.perf_counter() - started, status)
+
+
+async def ingest_driver(client, rec: Recorder, fleet: Fleet, cfg: dict, stop_at: float):
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    tasks = set()
+
+    async def send(name, path, body):
+        try:
+            if cfg["format"] == "packed":
+                encode = packed.encode_batch if isinstance(body, list) else packed.encode_record
+                await timed_request(
+                    client, rec, name, "POST", path, content=encode(body),
+                    headers={"Content-Type": packed.CONTENT_TYPE}
+                )
+            else:
+                await timed_request(client, rec, name, "POST", path, json=body)
+        finally:
+            in_flight.release()
+
+    def spawn(name, path, body):
+        if cfg["format"] == "packed":
+            name = name.replace("/ingest", "/ingest/packed")
+            path = path.replace("/ingest", "/ingest/packed")
+        task = asyncio.create_task(send(name, path, body))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    batch = cfg["batch"]
+    # In batch mode one tick sends `batch` readings per gateway
+    interval = (batch or 1) / cfg["rate"]
+    start = time.perf_counter()
+    tick = 0
+
+    while time.perf_counter() < stop_at:
+        target = start + tick * interval
+        delay = target - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -interval:
+            rec.behind += 1
+        tick += 1
+
+        readings = [fleet.reading() for _ in range(batch or 1)]
+        now = time.perf_counter()
+        for r in readings:
+            rec.sent_at[(r["node"], r["seq"])] = now
+
+        if batch:
+            per_gateway = zip(*(fleet.copies(r) for r in readings))
+            for copies in per_gateway:
+                await in_flight.acquire()
+                spawn("POST /ingest/batch", "/ingest/batch", list(copies))
+        else:
+            for copy in fleet.copies(readings[0]):
+                await in_flight.acquire()
+                spawn("POST /ingest", "/ingest", copy)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def dashboard_driver(client, rec: Recorder, cfg: dict, stop_at: float):
+    # Spread dashboards over the poll interval instead of polling in lockstep
+    await asyncio.sleep(random.uniform(0, cfg["poll_interval"]))
+    while time.perf_counter() < stop_at:
+        await timed_request(client, rec, "GET /nodes", "GET", "/nodes")
+        await timed_request(client, rec, "GET /incidents", "GET", "/incidents")
+        await asyncio.sleep(cfg["poll_interval"])
+
+
+async def ws_driver(ws_url: str, rec: Recorder, stop_at: float, ready: asyncio.Event, counter: list):
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        counter[0] += 1
+        if counter[0] == counter[1]:
+            ready.set()
+        while True:
+            remaining = stop_at + 2 - time.perf_counter()
+            if remaining <= 0:
+                return
+            try:
+                raw = await asyncio.wait_for(ws.recv(), remaining)
+            except asyncio.TimeoutError:
+                return
+            received = time.perf_counter()
+            rec.ws_messages += 1
+
+            msg = json.loads(raw)
+            if msg.get("type") != "node_update":
+                continue
+            data = msg["data"]
+            sent = rec.sent_at.get((data.get("node"), data.get("seq")))
+            if sent is not None:
+                rec.delivery_lag.append(received - sent)
+
+
+# -------------------------
+# Server under test
+# -------------------------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(db_path: str, workers: int, extra_env: dict) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        **extra_env,
+    }
+    if workers > 1:
+        env.setdefault("WS_BUS", "unix")
+        env.setdefault("WS_BUS_DIR", os.path.join(os.path.dirname(db_path), "bus"))
+
+    # Create the schema once, before several workers race for it
+    subprocess.run(
+        [sys.executable, "-m", "app.migrations", "upgrade"],
+        cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL
+    )
+
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning",
+        ],
+        cwd=ROOT, env=env,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            if httpx.get(url + "/", timeout=1).status_code == 200:
+                return proc, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("server did not become ready")
+
+
+def count_rows(db_path: str) -> int:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM telemetry").fetchone()[0]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -------------------------
+# Run
+# -------------------------
+async def run_load(url: str, cfg: dict, seed: int) -> tuple[Recorder, float]:
+    rec = Recorder()
+    fleet = Fleet(cfg["nodes"], cfg["gateways"], cfg["fire_ratio"], seed)
+    ws_url = url.replace("http", "ws", 1) + "/ws"
+
+    limits = httpx.Limits(max_connections=MAX_IN_FLIGHT + cfg["dashboards"])
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        # Subscribers connect before the first reading is sent
+        ready = asyncio.Event()
+        counter = [0, cfg["ws_clients"]]
+        far_future = time.perf_counter() + 3600
+        ws_tasks = [
+            asyncio.create_task(ws_driver(ws_url, rec, far_future, ready, counter))
+            for _ in range(cfg["ws_clients"])
+        ]
+        if ws_tasks:
+            await asyncio.wait_for(ready.wait(), 30)
+
+        started = time.perf_counter()
+        stop_at = started + cfg["duration"]
+
+        await asyncio.gather(
+            ingest_driver(client, rec, fleet, cfg, stop_at),
+            *(dashboard_driver(client, rec, cfg, stop_at) for _ in range(cfg["dashboards"])),
+        )
+        elapsed = time.perf_counter() - started
+
+        # Give the last frames time to arrive, then hang up
+        await asyncio.sleep(2)
+        for task in ws_tasks:
+            task.cancel()
+        await asyncio.gather(*ws_tasks, return_exceptions=True)
+
+    return rec, elapsed
+
+
+def run(args) -> dict:
+    cfg = dict(SCENARIOS[args.scenario], format=args.format)
+    for key in cfg:
+        value = getattr(args, key, None)
+        if value is not None:
+            cfg[key] = value
+
+    proc = None
+    db_path = None
+    tmp = None
+    url = args.url
+
+    if url is None:
+        tmp = tempfile.TemporaryDirectory(prefix="flames-bench-")
+        db_path = os.path.join(tmp.name, "bench.db")
+        proc, url = start_server(db_path, args.workers, {})
+
+    try:
+        rows_before = count_rows(db_path) if db_path else None
+        rec, elapsed = asyncio.run(run_load(url, cfg, args.seed))
+
+        rows_per_s = None
+        rows_written = None
+        if db_path:
+            # Let the ingest writer flush its last batch
+            time.sleep(1.5)
+            rows_written = count_rows(db_path) - rows_before
+            rows_per_s = round(rows_written / elapsed, 2)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if tmp is not None:
+            tmp.cleanup()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "scenario": args.scenario,
+        "config": {**cfg, "workers": args.workers, "seed": args.seed},
+        "elapsed_s": round(elapsed, 3),
+        "endpoints": {
+            name: {**summarize(samples, elapsed), "status": rec.status[name]}
+            for name, samples in sorted(rec.latency.items())
+        },
+        "websocket": {
+            "clients": cfg["ws_clients"],
+            "messages": rec.ws_messages,
+            "delivery_lag": summarize(rec.delivery_lag, elapsed),
+        },
+        "db": {"rows_written": rows_written, "rows_per_s": rows_per_s},
+        "readings_sent": len(rec.sent_at),
+        "generator_behind_ticks": rec.behind,
+    }
+
+
+def print_report(result: dict):
+    print(f"scenario {result['scenario']} @ {result['commit']}  ({result['elapsed_s']}s)")
+    print(f"{'endpoint':24} {'count':>8} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    rows = list(result["endpoints"].items())
+    rows.append(("ws delivery lag", result["websocket"]["delivery_lag"]))
+    for name, s in rows:
+        print(
+            f"{name:24} {s['count']:>8} {s['throughput_rps'] or 0:>9} "
+            f"{s['p50_ms'] or 0:>9} {s['p95_ms'] or 0:>9} {s['p99_ms'] or 0:>9}"
+        )
+    print(f"db rows/s: {result['db']['rows_per_s']}  ws messages: {result['websocket']['messages']}")
+
+
+def compare(old: dict, new: dict):
+    print(f"{old['commit']} -> {new['commit']} ({new['scenario']})")
+    names = sorted(set(old["endpoints"]) | set(new["endpoints"]))
+    pairs = [(n, old["endpoints"].get(n), new["endpoints"].get(n)) for n in names]
+    pairs.append((
+        "ws delivery lag",
+        old["websocket"]["delivery_lag"],
+        new["websocket"]["delivery_lag"],
+    ))
+    for name, a, b in pairs:
+        if not a or not b:
+            continue
+        for metric in ("throughput_rps", "p95_ms", "p99_ms"):
+            before, after = a[metric], b[metric]
+            if before and after:
+                change = (after - before) / before * 100
+                print(f"{name:24} {metric:15} {before:>10} -> {after:>10} ({change:+.1f}%)")
+    print(f"{'db':24} {'rows_per_s':15} {old['db']['rows_per_s']} -> {new['db']['rows_per_s']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bench/loadgen.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run")
+    p.add_argument("--scenario", choices=sorted(SCENARIOS), default="steady")
+    p.add_argument("--url", help="benchmark a running server instead of starting one")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--format", choices=("json", "packed"), default="json",
+                   help="ingest body encoding (packed: app/packed.py)")
+    p.add_argument("--out", help="JSON result path (default: bench/results/)")
+    for key, value in SCENARIOS["steady"].items():
+        p.add_argument(f"--{key.replace('_', '-')}", dest=key, type=type(value))
+
+    c = sub.add_parser("compare")
+    c.add_argument("old")
+    c.add_argument("new")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old) as f_old, open(args.new) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+        return 0
+
+    result = run(args)
+    print_report(result)
+
+    out = args.out
+    if out is None:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"{args.scenario}-{result['commit']}-{stamp}.json")
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"results written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())